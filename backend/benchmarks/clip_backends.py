@@ -0,0 +1,160 @@
+"""
+Compares the CLIP encoder backends of models.py: speed against agreement with fp32 and retrieval quality
+
+Every backend runs in its own interpreter (CLIP_BACKEND and CLIP_NUM_THREADS are read at import) and encodes
+the keyframes of the videos with ground truth in evaluations/, the label prompts of evaluation.py and the
+queries of the load test. The report has, per backend:
+    text query latency (single query, the request path) and image throughput (batches, the ingest path)
+    mean / min cosine similarity of its text and image vectors to the fp32 ones
+    micro F1 of the label predictions at CLIP_THRESHOLD and at the best shared threshold
+
+usage (from backend/): python -m benchmarks.clip_backends [--backends fp32 int8 torchscript] [--threads 4]
+                                                          [--videos 00184] [--batch-size 16] [--out clip_backends.csv]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from evaluation import SELECTED_OBJECTS, CLIP_THRESHOLD, SWEEP_THRESHOLDS, GROUND_TRUTH_FILE, load_csv, \
+    precision_recall
+from distance import cosine_many_to_many
+from benchmarks.load_test import SEARCH_QUERIES
+from constants import DATA_DIR
+
+
+def ground_truth_frames(video_ids: list[str]):
+    """
+    :return: frame images, (frames, labels) bool ground truth
+    """
+    images, truth = [], []
+    for video_id in video_ids:
+        gt = load_csv(GROUND_TRUTH_FILE.format(video_id=video_id))
+        for frame_id, row in gt[SELECTED_OBJECTS].iterrows():
+            images.append(Image.open(os.path.join(DATA_DIR, video_id, 'frames', f'{frame_id}.jpeg')).convert('RGB'))
+            truth.append(row.to_numpy(dtype=bool))
+
+    return images, np.array(truth, dtype=bool)
+
+
+def prompts() -> list[str]:
+    return [f"a photo of an {label}" for label in SELECTED_OBJECTS]
+
+
+# --------------------------- Worker, one backend
+def run_backend(video_ids: list[str], batch_size: int, out_file: str):
+    from utils import encode_texts, encode_images
+
+    images, _ = ground_truth_frames(video_ids)
+
+    # First calls load the towers, not timed
+    start = time.perf_counter()
+    encode_texts(['warm up'])
+    encode_images(images[:1])
+    load_time = time.perf_counter() - start
+
+    latencies = []
+    for query in SEARCH_QUERIES:
+        start = time.perf_counter()
+        encode_texts([query])
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    image_vectors = []
+    for i in range(0, len(images), batch_size):
+        image_vectors += encode_images(images[i:i + batch_size])
+    image_time = time.perf_counter() - start
+
+    np.savez(out_file, load_time=load_time, text_latencies=np.array(latencies),
+             images_per_second=len(images) / image_time,
+             query_vectors=np.array(encode_texts(SEARCH_QUERIES), dtype=np.float32),
+             prompt_vectors=np.array(encode_texts(prompts()), dtype=np.float32),
+             image_vectors=np.array(image_vectors, dtype=np.float32))
+
+
+def spawn_backend(backend: str, threads: int, video_ids: list[str], batch_size: int) -> dict:
+    env = dict(os.environ, CLIP_BACKEND=backend, CLIP_NUM_THREADS=str(threads))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        out_file = os.path.join(tmp, f'{backend}.npz')
+        subprocess.run([sys.executable, '-m', 'benchmarks.clip_backends', '--worker', out_file,
+                        '--videos', *video_ids, '--batch-size', str(batch_size)], env=env, check=True)
+
+        with np.load(out_file) as data:
+            return {k: data[k] for k in data.files}
+
+
+# --------------------------- Report
+def agreement(vectors: np.ndarray, reference: np.ndarray):
+    """
+    :return: mean and min cosine similarity of matching rows
+    """
+    similarity = 1 - np.diagonal(cosine_many_to_many(vectors, reference))
+    return float(similarity.mean()), float(similarity.min())
+
+
+def micro_f1(distances: np.ndarray, truth: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+    predictions = distances[:, :, None] < thresholds[None, None, :]
+    tp = (predictions & truth[:, :, None]).sum(axis=(0, 1))
+    total = predictions.sum(axis=(0, 1)) + truth.sum()
+
+    return np.divide(2 * tp, total, out=np.zeros(len(thresholds)), where=total > 0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backends', nargs='+', default=['fp32', 'int8', 'torchscript'])
+    parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 for the torch default')
+    parser.add_argument('--videos', nargs='+', default=['00184'], help='videos with ground truth in evaluations/')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--out', default='clip_backends.csv')
+    parser.add_argument('--worker', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_backend(args.videos, args.batch_size, args.worker)
+        return
+
+    _, truth = ground_truth_frames(args.videos)
+    results = {backend: spawn_backend(backend, args.threads, args.videos, args.batch_size)
+               for backend in args.backends}
+    reference = results.get('fp32')
+
+    rows = []
+    for backend, r in results.items():
+        distances = cosine_many_to_many(r['image_vectors'], r['prompt_vectors'])
+        _, _, f1 = precision_recall(distances < CLIP_THRESHOLD, truth)
+        sweep = micro_f1(distances, truth, SWEEP_THRESHOLDS)
+
+        row = {
+            'backend': backend,
+            'load (s)': float(r['load_time']),
+            'text p50 (ms)': float(np.percentile(r['text_latencies'], 50) * 1000),
+            'text p99 (ms)': float(np.percentile(r['text_latencies'], 99) * 1000),
+            'images / s': float(r['images_per_second']),
+            'micro F1 @ threshold': float(micro_f1(distances, truth, np.array([CLIP_THRESHOLD]))[0]),
+            'mean label F1 @ threshold': float(f1.mean()),
+            'best micro F1': float(sweep.max()),
+            'best threshold': float(SWEEP_THRESHOLDS[int(np.argmax(sweep))]),
+        }
+        if reference is not None:
+            row['text agreement (mean)'], row['text agreement (min)'] = agreement(r['query_vectors'],
+                                                                                 reference['query_vectors'])
+            row['image agreement (mean)'], row['image agreement (min)'] = agreement(r['image_vectors'],
+                                                                                   reference['image_vectors'])
+        rows.append(row)
+
+    report = pd.DataFrame(rows).set_index('backend')
+    report.to_csv(args.out)
+
+    print(f"{len(truth)} ground truth frames, {len(SEARCH_QUERIES)} text queries, threads {args.threads or 'default'}")
+    print(report.round(4).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Cold-start cost of the server and of the lazily loaded models, every case in a fresh interpreter
+
+usage (from backend/): python -m benchmarks.cold_start [--repeat 3] [--serve]
+    --serve also starts server.py and times the first response of / and of /explore/<video_id>
+"""
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+import requests
+
+CASES = {
+    'import server': """
+import server
+""",
+    'first text query (text tower)': """
+from utils import encode_texts
+encode_texts(['a person riding a bicycle'])
+""",
+    'first image query (image tower)': """
+from PIL import Image
+from utils import encode_image
+encode_image(Image.new('RGB', (224, 224)))
+""",
+    'full CLIP model': """
+from models import get_clip
+get_clip()
+""",
+}
+
+# Wraps a case: prints its wall time and whether torch got imported
+RUNNER = """
+import sys, time, json
+start = time.perf_counter()
+{code}
+print(json.dumps({{'seconds': time.perf_counter() - start, 'torch': 'torch' in sys.modules}}))
+"""
+
+
+def run_case(code: str) -> dict:
+    output = subprocess.run([sys.executable, '-c', RUNNER.format(code=code)], capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def wait_for(url: str, timeout: float = 300) -> float:
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        try:
+            requests.get(url, timeout=5)
+            return time.perf_counter() - start
+        except requests.ConnectionError:
+            time.sleep(0.05)
+
+    raise Exception(f"No response from {url} after {timeout}s")
+
+
+def time_server(video_id: str) -> tuple[float, float]:
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, 'server.py'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        ready = wait_for('http://127.0.0.1:5000/')
+        requests.get(f'http://127.0.0.1:5000/explore/{video_id}', timeout=60)
+        return ready, time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--serve', action='store_true')
+    parser.add_argument('--video-id', default='00001')
+    args = parser.parse_args()
+
+    print("Case, median (s), min (s), Imports torch")
+    for name, code in CASES.items():
+        results = [run_case(code) for _ in range(args.repeat)]
+        seconds = [r['seconds'] for r in results]
+        print(f"{name} -> {np.median(seconds):.2f}, {min(seconds):.2f}, {results[0]['torch']}")
+
+    if args.serve:
+        timings = np.array([time_server(args.video_id) for _ in range(args.repeat)])
+        print(f"server ready -> {np.median(timings[:, 0]):.2f}, {timings[:, 0].min():.2f}")
+        print(f"first /explore -> {np.median(timings[:, 1]):.2f}, {timings[:, 1].min():.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Compares utils.get_image_colors with the previous PIL getcolors implementation
+
+usage (from backend/): python -m benchmarks.colors [images ...] [--repeat 5] [--max-side 512]
+Without images a synthetic full-HD frame is used.
+"""
+import time
+import argparse
+import numpy as np
+from PIL import Image
+
+from utils import get_image_colors
+
+
+def get_image_colors_pil(image: Image):
+    # Previous implementation, kept as the reference
+    r, g, b = image.split()
+
+    pixels = image.getcolors(image.width * image.height)
+
+    dominant_colors = [list(px[1]) for px in sorted(pixels, key=lambda t: t[0])[-10:]]
+
+    return dominant_colors, r.histogram(), g.histogram(), b.histogram()
+
+
+def synthetic_frame(width: int = 1920, height: int = 1080) -> Image:
+    # Smooth gradients with noise, many distinct colors like a natural frame
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 1, width)[None, :, None]
+    y = np.linspace(0, 1, height)[:, None, None]
+    base = np.concatenate([x * 200 + 0 * y, y * 200 + 0 * x, (x + y) * 100], axis=2)
+    noise = rng.integers(0, 40, (height, width, 3))
+
+    return Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8))
+
+
+def best_time(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return min(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('images', nargs='*')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-side', type=int, default=512)
+    args = parser.parse_args()
+
+    images = [Image.open(p).convert('RGB') for p in args.images] if args.images else [synthetic_frame()]
+
+    print("Image, PIL (ms), NumPy (ms), NumPy downscaled (ms), Histograms equal, Dominant colors equal")
+    for i, image in enumerate(images):
+        reference = get_image_colors_pil(image)
+        result = get_image_colors(image)
+
+        t_pil = best_time(lambda: get_image_colors_pil(image), args.repeat)
+        t_np = best_time(lambda: get_image_colors(image), args.repeat)
+        t_small = best_time(lambda: get_image_colors(image, args.max_side), args.repeat)
+
+        histograms_equal = reference[1:] == result[1:]
+        # Colors with tied counts can be ordered differently
+        colors_equal = sorted(reference[0]) == sorted(result[0])
+
+        name = args.images[i] if args.images else f'synthetic {image.width}x{image.height}'
+        print(f"{name} -> {t_pil:.1f}, {t_np:.1f}, {t_small:.1f}, {histograms_equal}, {colors_equal}")
+
+
+if __name__ == '__main__':
+    main()
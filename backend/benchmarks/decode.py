@@ -0,0 +1,45 @@
+"""
+Compares the keyframe decoding modes of extract_data on one video
+
+usage (from backend/): python -m benchmarks.decode <video_id> [--modes read grab seek]
+"""
+import time
+import argparse
+import numpy as np
+
+from extract_data import decode_keyframes, process_video
+
+
+def run_mode(video_path: str, fps: float, keyframe_ts: list[float], mode: str):
+    start = time.perf_counter()
+    frames = list(decode_keyframes(video_path, fps, list(keyframe_ts), mode))
+    elapsed = time.perf_counter() - start
+
+    return elapsed, frames
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('video_id')
+    parser.add_argument('--modes', nargs='+', default=['read', 'grab', 'seek'])
+    args = parser.parse_args()
+
+    video_path, fps, timeperiod, duration, keyframe_ts = process_video(args.video_id, compress=False)
+    print(f"{args.video_id}: {duration:.1f}s @ {fps:.2f} fps, {len(keyframe_ts)} keyframes")
+
+    reference = None
+    print("Mode, Time (s), Keyframes, Max pixel diff vs first mode")
+    for mode in args.modes:
+        elapsed, frames = run_mode(video_path, fps, keyframe_ts, mode)
+
+        if reference is None:
+            reference = frames
+
+        diff = max([int(np.abs(a[1].astype(np.int16) - b[1].astype(np.int16)).max())
+                    for a, b in zip(reference, frames)], default=0)
+
+        print(f"{mode} -> {elapsed:.2f}, {len(frames)}, {diff}")
+
+
+if __name__ == '__main__':
+    main()
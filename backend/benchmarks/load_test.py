@@ -0,0 +1,89 @@
+"""
+Load test for the search server, reports latency percentiles per concurrency level
+
+usage (from backend/, with the server running):
+    python -m benchmarks.load_test [--url http://127.0.0.1:5000] [--concurrency 1 2 4 8 16] [--requests 100]
+"""
+import time
+import argparse
+import numpy as np
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+SEARCH_QUERIES = [
+    "a person riding a bicycle",
+    "a boat on the water",
+    "people sitting on a bench in a park",
+    "a red car on a street",
+    "a close up of a face",
+]
+
+SEARCH_PARAMS = {
+    'maxResults': 100,
+    'colorRadius': 20,
+    'maxTextSimilarity': 0.875,
+    'maxImageSimilarity': 0.875,
+    'objectsContain': 'any'
+}
+
+
+def search_body(i: int) -> dict:
+    return {
+        'query': {
+            'textQuery': SEARCH_QUERIES[i % len(SEARCH_QUERIES)],
+            'imageQuery': None,
+            'objectQuery': [],
+            'colorQuery': None,
+            'wordQuery': []
+        },
+        'searchParams': SEARCH_PARAMS
+    }
+
+
+def timed_request(session: requests.Session, url: str, endpoint: str, i: int, video_ids: list[str]):
+    start = time.perf_counter()
+
+    if endpoint == 'search':
+        res = session.post(f"{url}/search", json=search_body(i))
+    else:
+        res = session.get(f"{url}/explore/{video_ids[i % len(video_ids)]}")
+
+    return time.perf_counter() - start, res.status_code == 200
+
+
+def run_level(url: str, endpoint: str, concurrency: int, num_requests: int, video_ids: list[str]):
+    sessions = [requests.Session() for _ in range(concurrency)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(lambda i: timed_request(sessions[i % concurrency], url, endpoint, i, video_ids),
+                                    range(num_requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([r[0] for r in results]) * 1000
+    errors = len([r for r in results if not r[1]])
+
+    return np.percentile(latencies, 50), np.percentile(latencies, 99), num_requests / elapsed, errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--endpoint', choices=['search', 'explore'], default='search')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--requests', type=int, default=100, help='requests per concurrency level')
+    parser.add_argument('--videos', nargs='+', default=['00184'], help='video ids used for /explore')
+    args = parser.parse_args()
+
+    # Warm up, the first request loads the models
+    timed_request(requests.Session(), args.url, args.endpoint, 0, args.videos)
+
+    print(f"/{args.endpoint}, {args.requests} requests per level")
+    print("Concurrency, p50 (ms), p99 (ms), Requests/s, Errors")
+    for concurrency in args.concurrency:
+        p50, p99, throughput, errors = run_level(args.url, args.endpoint, concurrency, args.requests, args.videos)
+        print(f"{concurrency} -> {p50:.1f}, {p99:.1f}, {throughput:.2f}, {errors}")
+
+
+if __name__ == '__main__':
+    main()
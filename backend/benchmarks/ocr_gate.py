@@ -0,0 +1,106 @@
+"""
+Recall lost against time saved by the gated OCR of utils.get_text_in_image_gated
+
+Every keyframe of the videos is OCRed in full (EasyOCR readtext at full resolution, the reference), scored by
+the text presence gate and run through detection on the downscaled frame + recognition of the regions.
+For every gate threshold the report gives the share of frames OCRed, the recall of the reference words and of
+the frames with text, and the OCR time against the full OCR time.
+
+usage (from backend/): python -m benchmarks.ocr_gate --videos 00001 00002 [--max-frames 200] [--out ocr_gate.csv]
+"""
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from utils import get_text_in_image, text_presence, detect_text_regions, get_ocr, _ocr_result_to_words, \
+    TEXT_GATE_THRESHOLD
+from thumbnails import frame_ids, frame_path
+
+THRESHOLDS = [0, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02]
+
+
+def words(text: list[str]) -> set[str]:
+    return {w for w in text if w}
+
+
+def measure(image: Image) -> dict:
+    start = time.perf_counter()
+    reference = words(get_text_in_image(image))
+    full_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    score = text_presence(image)
+    gate_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    frame = np.array(image.convert('RGB'))
+    horizontal, free = detect_text_regions(frame)
+    gated = set()
+    if horizontal or free:
+        gated = words(_ocr_result_to_words(get_ocr().recognize(frame, horizontal_list=horizontal, free_list=free)))
+    gated_time = time.perf_counter() - start
+
+    return {
+        'score': score,
+        'reference': reference,
+        'gated': gated,
+        'full_time': full_time,
+        'gate_time': gate_time,
+        'gated_time': gated_time
+    }
+
+
+def report(frames: list[dict], thresholds: list[float]) -> pd.DataFrame:
+    total_words = sum([len(f['reference']) for f in frames])
+    text_frames = sum([1 for f in frames if f['reference']])
+    full_time = sum([f['full_time'] for f in frames])
+    gate_time = sum([f['gate_time'] for f in frames])
+
+    rows = []
+    for t in thresholds:
+        kept = [f for f in frames if f['score'] >= t]
+        found = sum([len(f['reference'] & f['gated']) for f in kept])
+        time_spent = gate_time + sum([f['gated_time'] for f in kept])
+
+        rows.append({
+            'threshold': t,
+            'frames OCRed': len(kept) / len(frames),
+            'word recall': found / total_words if total_words else 1.0,
+            'text frame recall': sum([1 for f in kept if f['reference']]) / text_frames if text_frames else 1.0,
+            'time (s)': time_spent,
+            'full OCR time (s)': full_time,
+            'speedup': full_time / time_spent if time_spent > 0 else float('inf'),
+        })
+
+    return pd.DataFrame(rows).set_index('threshold')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--videos', nargs='+', required=True)
+    parser.add_argument('--max-frames', type=int, default=None, help='keyframes per video')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=THRESHOLDS)
+    parser.add_argument('--out', default='ocr_gate.csv')
+    args = parser.parse_args()
+
+    # Loads the reader before timing
+    get_ocr()
+
+    frames = []
+    for video_id in args.videos:
+        for frame_id in frame_ids(video_id)[:args.max_frames]:
+            with Image.open(frame_path(video_id, frame_id)) as image:
+                frames.append(measure(image.convert('RGB')))
+
+    result = report(frames, args.thresholds)
+    result.to_csv(args.out)
+
+    print(f"{len(frames)} keyframes, {sum([1 for f in frames if f['reference']])} with text, "
+          f"current TEXT_GATE_THRESHOLD {TEXT_GATE_THRESHOLD}")
+    print(result.round(3).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Compares the pgvector and in-process search backends on the same queries
+
+usage (from backend/, with the database loaded and the index built by vector_index.py):
+    python -m benchmarks.search_backends [--queries 50] [--max-results 100] [--encode]
+"""
+import time
+import argparse
+import numpy as np
+
+from search_engine import SearchQuery, PostgresBackend
+from vector_index import VectorIndex
+from benchmarks.load_test import SEARCH_QUERIES
+
+
+def make_query(vec: list[float], max_results: int) -> SearchQuery:
+    return SearchQuery(
+        text_vec=vec,
+        image_vec=None,
+        objects=[],
+        objects_contain='any',
+        color=None,
+        color_radius=0,
+        words=[],
+        word_match='exact',
+        max_text_distance=1.0,
+        max_image_distance=1.0,
+        max_results=max_results
+    )
+
+
+def time_backend(backend, queries: list[SearchQuery]):
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(backend.search(query))
+        latencies.append(time.perf_counter() - start)
+
+    return np.array(latencies) * 1000, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--max-results', type=int, default=100)
+    parser.add_argument('--encode', action='store_true', help='encode real text queries instead of using frame vectors')
+    parser.add_argument('--nprobe', type=int, default=None, help='IVF lists probed by the in-process index')
+    args = parser.parse_args()
+
+    index = VectorIndex()
+    if args.nprobe:
+        index.nprobe = args.nprobe
+
+    if args.encode:
+        from utils import encode_texts
+        vectors = encode_texts([SEARCH_QUERIES[i % len(SEARCH_QUERIES)] for i in range(args.queries)])
+    else:
+        # Slightly perturbed frame vectors stand in for queries
+        rng = np.random.default_rng(0)
+        rows = rng.choice(len(index), args.queries)
+        vectors = (np.asarray(index.vectors[rows]) + rng.normal(0, 0.01, (args.queries, index.vectors.shape[1]))).tolist()
+
+    queries = [make_query(v, args.max_results) for v in vectors]
+
+    print(f"{len(index)} frames, {args.queries} queries, top {args.max_results}")
+    print("Backend, p50 (ms), p99 (ms), Overlap with postgres")
+
+    pg_latencies, pg_results = time_backend(PostgresBackend(), queries)
+    print(f"postgres -> {np.percentile(pg_latencies, 50):.2f}, {np.percentile(pg_latencies, 99):.2f}, 1.0")
+
+    mem_latencies, mem_results = time_backend(index, queries)
+    overlap = np.mean([
+        len({(r['video_id'], r['frame_id']) for r in a} & {(r['video_id'], r['frame_id']) for r in b}) / max(len(a), 1)
+        for a, b in zip(pg_results, mem_results)
+    ])
+    print(f"memory -> {np.percentile(mem_latencies, 50):.2f}, {np.percentile(mem_latencies, 99):.2f}, {overlap:.3f}")
+
+
+if __name__ == '__main__':
+    main()
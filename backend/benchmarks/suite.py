@@ -0,0 +1,282 @@
+"""
+Offline benchmark suite, runs on a synthetic corpus with stub encoders (see benchmarks/synthetic.py)
+
+Covers the color helpers, the distance functions, get_image_colors, the COPY formatting of the insert_to_db
+loader, the search SQL builders and rerank, and the /search variants end to end through the Flask app on the
+in-process backend. Every benchmark is called --repeat times and reports the throughput (calls/s) and the
+min / median / p95 latency per call.
+Results can be saved as a baseline and later runs compared against it, a median slowdown beyond --tolerance
+is reported as a regression and makes the run exit with status 1.
+
+usage (from backend/):
+    python -m benchmarks.suite [--sizes 1000 10000 100000] [--repeat 20] [--only distance search]
+                               [--save-baseline benchmarks/baseline.json] [--baseline benchmarks/baseline.json]
+"""
+import io
+import sys
+import json
+import time
+import base64
+import argparse
+import tempfile
+import statistics
+import numpy as np
+
+from benchmarks.synthetic import Corpus, STUB_ENCODERS
+from benchmarks.colors import synthetic_frame
+from benchmarks.load_test import SEARCH_PARAMS
+
+
+def measure(fn, repeat: int) -> dict:
+    """
+    :return: calls per second and min / median / p95 wall time of fn in milliseconds, after one warm-up call
+    """
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    times = np.array(times) * 1000
+    return {
+        'calls/s': len(times) / times.sum() * 1000 if times.sum() > 0 else float('inf'),
+        'min': float(times.min()),
+        'median': statistics.median(times.tolist()),
+        'p95': float(np.percentile(times, 95)),
+    }
+
+
+class CopySink:
+    """
+    Stands in for the psycopg2 cursor of insert_to_db.copy_rows, reads the COPY data and discards it
+    """
+
+    def __init__(self):
+        self.bytes = 0
+
+    def copy_expert(self, sql: str, file):
+        self.bytes += len(file.read())
+
+
+# --------------------------- Benchmarks, each returns {name: callable}
+def colors_benchmarks(corpus: Corpus) -> dict:
+    from utils_server import get_neighbour_colors, get_neighbour_color_bins, color_distances, pack_colors
+
+    codes = [pack_colors(c) for c in corpus.colors]
+    return {
+        'get_neighbour_colors[n=20]': lambda: get_neighbour_colors([120, 80, 200], 20),
+        'get_neighbour_color_bins[n=20]': lambda: get_neighbour_color_bins([120, 80, 200], 20),
+        f'color_distances[frames={corpus.size}]': lambda: color_distances(codes, [120, 80, 200]),
+    }
+
+
+def distance_benchmarks(corpus: Corpus) -> dict:
+    from distance import l2, cosine, l2_one_to_many, l2_consecutive, cosine_one_to_many, cosine_many_to_many
+
+    x, y = corpus.vectors[0].tolist(), corpus.vectors[1].tolist()
+    queries = corpus.vectors[:16]
+    n = corpus.size
+    return {
+        'l2[pair]': lambda: l2(x, y),
+        'cosine[pair]': lambda: cosine(x, y),
+        f'l2_one_to_many[n={n}]': lambda: l2_one_to_many(corpus.vectors[0], corpus.vectors),
+        f'l2_consecutive[n={n}]': lambda: l2_consecutive(corpus.vectors),
+        f'cosine_one_to_many[n={n}]': lambda: cosine_one_to_many(corpus.vectors[0], corpus.vectors),
+        f'cosine_many_to_many[16x{n}]': lambda: cosine_many_to_many(queries, corpus.vectors),
+    }
+
+
+def image_colors_benchmarks(corpus: Corpus) -> dict:
+    from utils import get_image_colors
+
+    frame = synthetic_frame()
+    return {
+        'get_image_colors[1920x1080]': lambda: get_image_colors(frame),
+        'get_image_colors[max_side=512]': lambda: get_image_colors(frame, 512),
+    }
+
+
+def loader_benchmarks(corpus: Corpus) -> dict:
+    from insert_to_db import copy_rows
+
+    rows = list(corpus.rows())
+    return {
+        f'copy_rows[rows={corpus.size}]': lambda: copy_rows(CopySink(), rows),
+    }
+
+
+def search_bodies(corpus: Corpus) -> dict:
+    def body(text=None, image=None, objects=None, color=None, words=None, word_match='exact'):
+        return {
+            'query': {'textQuery': text, 'imageQuery': image, 'objectQuery': objects or [], 'colorQuery': color,
+                      'wordQuery': words or []},
+            'searchParams': {**SEARCH_PARAMS, 'wordMatch': word_match}
+        }
+
+    image = io.BytesIO()
+    synthetic_frame(64, 64).save(image, 'PNG')
+    image = 'data:image/png;base64,' + base64.b64encode(image.getvalue()).decode()
+
+    return {
+        'text': body(text='a person riding a bicycle'),
+        'text+objects': body(text='a person riding a bicycle', objects=['person', 'bicycle']),
+        'text+color': body(text='a red car', color=[200, 30, 30]),
+        'text+words': body(text='a sign', words=corpus.vocabulary[:3]),
+        'words:prefix': body(words=['word1'], word_match='prefix'),
+        'words:fuzzy': body(words=['wrod12', 'word7x'], word_match='fuzzy'),
+        'text+image': body(text='a boat on the water', image=image),
+        'color': body(color=[200, 30, 30]),
+    }
+
+
+def sql_benchmarks(corpus: Corpus) -> dict:
+    from search_engine import SearchQuery, build_search_sql, build_ranked_sql, build_batch_sql, rerank
+    from utils_server import pack_colors
+
+    encoder = STUB_ENCODERS['hash']()
+    queries = {name: SearchQuery.from_request(b, encoder.encode_texts([b['query']['textQuery']])[0]
+                                              if b['query']['textQuery'] else None, None)
+               for name, b in search_bodies(corpus).items()}
+
+    # Candidate rows as build_search_sql returns them
+    k = queries['text'].num_candidates()
+    rng = np.random.default_rng(0)
+    candidates = [(corpus.video_ids[i], corpus.frame_ids[i], corpus.timestamps[i], pack_colors(corpus.colors[i]),
+                   corpus.objects[i], corpus.text[i], float(rng.random()), None) for i in range(min(k, corpus.size))]
+
+    benchmarks = {f'build_search_sql[{name}]': (lambda q=q: build_search_sql(q)) for name, q in queries.items()}
+    benchmarks['build_ranked_sql[text]'] = lambda: build_ranked_sql(queries['text'])
+    benchmarks['build_batch_sql[8]'] = lambda: build_batch_sql([queries['text']] * 8)
+    benchmarks[f'rerank[rows={len(candidates)}]'] = lambda: rerank(candidates, queries['text'])
+    benchmarks[f'rerank+color[rows={len(candidates)}]'] = lambda: rerank(candidates, queries['text+color'])
+    return benchmarks
+
+
+def search_benchmarks(corpus: Corpus, index_dir: str) -> dict:
+    import server
+    import query_cache
+    import search_engine
+    from vector_index import VectorIndex, write_index
+
+    write_index(corpus.rows(), index_dir)
+    search_engine._backend = VectorIndex(index_dir)
+
+    # Stub encoders in place of CLIP, the query cache is bypassed so every request encodes
+    encoder = STUB_ENCODERS['corpus'](corpus.vectors)
+    query_cache.encode_texts = encoder.encode_texts
+    query_cache.encode_image_bytes = lambda image_bytes, decode: encoder.encode_image(decode(image_bytes))
+    query_cache.cache.maxsize = 0
+
+    client = server.app.test_client()
+    bodies = search_bodies(corpus)
+
+    def check(url: str, response):
+        if response.status_code != 200:
+            raise Exception(f"{url} returned {response.status_code}: {response.get_data(as_text=True)[:200]}")
+
+    def post(url: str, body: dict):
+        check(url, client.post(url, json=body))
+
+    def get(url: str):
+        check(url, client.get(url))
+
+    benchmarks = {f'/search[{name}]': (lambda b=b: post('/search', b)) for name, b in bodies.items()}
+    benchmarks['/search/batch[8]'] = lambda: post('/search/batch', {'queries': [bodies['text']] * 8})
+    benchmarks['/search/temporal[3]'] = lambda: post('/search/temporal', {
+        'queries': [bodies['text'], bodies['text+objects'], bodies['text+color']], 'maxGap': 10})
+    benchmarks['/explore'] = lambda: get(f'/explore/{corpus.video_ids[0]}')
+    return benchmarks
+
+
+GROUPS = {
+    'colors': colors_benchmarks,
+    'distance': distance_benchmarks,
+    'image_colors': image_colors_benchmarks,
+    'loader': loader_benchmarks,
+    'sql': sql_benchmarks,
+    'search': search_benchmarks,
+}
+
+# Groups that do not depend on the corpus size run once
+SIZE_INDEPENDENT = {'image_colors'}
+
+
+# --------------------------- Report
+def run(sizes: list[int], groups: list[str], repeat: int) -> dict:
+    results = {}
+
+    for i, size in enumerate(sizes):
+        corpus = Corpus(size)
+        print(f"corpus of {size} frames")
+
+        for group in groups:
+            if group in SIZE_INDEPENDENT and i > 0:
+                continue
+
+            with tempfile.TemporaryDirectory() as tmp:
+                benchmarks = GROUPS[group](corpus, tmp) if group == 'search' else GROUPS[group](corpus)
+
+                for name, fn in benchmarks.items():
+                    key = f'{group}.{name}' + ('' if group in SIZE_INDEPENDENT else f'@{size}')
+                    results[key] = measure(fn, repeat)
+                    r = results[key]
+                    print(f"  {key} -> {r['calls/s']:.1f} calls/s, min {r['min']:.3f} ms, "
+                          f"median {r['median']:.3f} ms, p95 {r['p95']:.3f} ms")
+
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    :return: names of the benchmarks whose median is slower than the baseline by more than tolerance
+    """
+    regressions = []
+
+    print()
+    print("Benchmark, Baseline median (ms), Current median (ms), Ratio")
+    for name, r in results.items():
+        ms = r['median']
+        if name not in baseline:
+            print(f"{name} -> -, {ms:.3f}, new")
+            continue
+
+        # Baselines saved before the latency percentiles have the best time only
+        base = baseline[name]['median'] if isinstance(baseline[name], dict) else baseline[name]
+        ratio = ms / base if base > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print(f"{name} -> {base:.3f}, {ms:.3f}, {ratio:.2f}x{flag}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--only', nargs='+', choices=list(GROUPS), default=list(GROUPS))
+    parser.add_argument('--baseline', default=None, help='JSON file of a previous run to compare against')
+    parser.add_argument('--save-baseline', default=None, help='write the results of this run to a JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before a regression, 0.2 = 20%%')
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.only, args.repeat)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+        if regressions:
+            print(f"\n{len(regressions)} regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Synthetic corpus and stub encoders for the offline benchmarks, no videos, model weights or database needed
+
+The corpus has the shape of the real one: rows like insert_to_db.get_data yields them, with clustered
+768-d vectors, YOLO object lists, up to 10 dominant colors and OCR tokens. Encoders are stubs that map a
+text or an image to a deterministic vector, pick one from STUB_ENCODERS.
+"""
+import hashlib
+import numpy as np
+from typing import List
+
+from constants import YOLO_CLASSES
+
+DIM = 768
+FRAMES_PER_VIDEO = 200
+VOCABULARY_SIZE = 5000
+
+
+def _seed(data: bytes) -> int:
+    return int.from_bytes(hashlib.sha256(data).digest()[:8], 'big')
+
+
+# --------------------------- Stub encoders
+class HashEncoder:
+    """
+    Gaussian vector seeded by the hash of the input, the same text always gets the same vector
+    """
+
+    def __init__(self, dim: int = DIM):
+        self.dim = dim
+
+    def _vector(self, data: bytes) -> List[float]:
+        return np.random.default_rng(_seed(data)).standard_normal(self.dim).astype(np.float32).tolist()
+
+    def encode_texts(self, texts: List[str]) -> List[List[float]]:
+        return [self._vector(t.encode()) for t in texts]
+
+    def encode_image(self, image) -> List[float]:
+        return self._vector(np.asarray(image).tobytes())
+
+
+class CorpusEncoder(HashEncoder):
+    """
+    Vectors close to frames of a corpus, so the similarity thresholds let results through like real queries do
+    """
+
+    def __init__(self, vectors: np.ndarray, noise: float = 0.01):
+        super().__init__(vectors.shape[1])
+        self.vectors = vectors
+        self.noise = noise
+
+    def _vector(self, data: bytes) -> List[float]:
+        rng = np.random.default_rng(_seed(data))
+        vec = self.vectors[rng.integers(len(self.vectors))]
+        return (vec + rng.normal(0, self.noise, vec.shape)).astype(np.float32).tolist()
+
+
+STUB_ENCODERS = {
+    'hash': HashEncoder,
+    'corpus': CorpusEncoder,
+}
+
+
+# --------------------------- Corpus
+class Corpus:
+
+    def __init__(self, size: int, seed: int = 0, clusters: int = 64):
+        """
+        :param size: number of frames
+        """
+        rng = np.random.default_rng(seed)
+        self.size = size
+
+        # Frames of a video are close to one of a few centers, as keyframes of the same footage are
+        centers = rng.standard_normal((clusters, DIM)).astype(np.float32)
+        self.vectors = (centers[rng.integers(clusters, size=size)] * 0.5 +
+                        rng.standard_normal((size, DIM)).astype(np.float32))
+
+        self.video_ids = [f'{i // FRAMES_PER_VIDEO:05d}' for i in range(size)]
+        self.frame_ids = [f'frame_{i % FRAMES_PER_VIDEO + 1}' for i in range(size)]
+        self.timestamps = (np.arange(size) % FRAMES_PER_VIDEO) * 2.5 + rng.random(size)
+
+        # A few objects per frame, the frequent classes (person, car, ...) more often
+        popularity = 1 / np.arange(1, len(YOLO_CLASSES) + 1)
+        popularity /= popularity.sum()
+        self.objects = [sorted({YOLO_CLASSES[c] for c in rng.choice(len(YOLO_CLASSES), rng.integers(0, 5), p=popularity)})
+                        for _ in range(size)]
+
+        self.colors = [rng.integers(0, 256, (rng.integers(1, 11), 3)).tolist() for _ in range(size)]
+
+        # Zipf distributed tokens, most frames have no text
+        self.vocabulary = [f'word{i}' for i in range(VOCABULARY_SIZE)]
+        self.text = [[self.vocabulary[min(int(w), VOCABULARY_SIZE) - 1] for w in rng.zipf(1.5, rng.integers(1, 6))]
+                     if rng.random() < 0.3 else [] for _ in range(size)]
+
+    def rows(self):
+        """
+        :return: yields (video_id, frame_id, objects, image_vector, dominant_colors, timestamp, text) like get_data
+        """
+        for i in range(self.size):
+            yield (self.video_ids[i], self.frame_ids[i], self.objects[i], self.vectors[i].tolist(), self.colors[i],
+                   float(self.timestamps[i]), self.text[i])
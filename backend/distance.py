@@ -1,13 +1,93 @@
 import numpy as np
 from numpy.typing import ArrayLike
 
+NORM_EPS = 1e-50
+
 
 def l2(x: ArrayLike, y: ArrayLike) -> float:
     return np.linalg.norm(np.array(x) - np.array(y)) ** 2
 
 
 def cosine(x: ArrayLike, y: ArrayLike) -> float:
-    NORM_EPS = 1e-50
     x = np.array(x)
     y = np.array(y)
     return 1 - np.dot(x, y) / ((np.linalg.norm(x) + NORM_EPS) * (np.linalg.norm(y) + NORM_EPS))
+
+
+# Batched variants. Inputs are (n, dim) arrays (or lists), float16 inputs are computed in float32.
+# l2_* return squared L2 distances like l2, cosine_* return 1 - cosine similarity like cosine.
+def _as_array(x: ArrayLike) -> np.ndarray:
+    x = np.asarray(x)
+    if x.dtype == np.float16 or not np.issubdtype(x.dtype, np.floating):
+        x = x.astype(np.float32)
+    return x
+
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    # NORM_EPS vanishes in float32, zero vectors are guarded with a float32 sized epsilon instead
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+
+def l2_one_to_many(x: ArrayLike, ys: ArrayLike) -> np.ndarray:
+    """
+    :return: (n,) distances from x to every row of ys
+    """
+    diff = _as_array(ys) - _as_array(x)
+    return np.einsum('ij,ij->i', diff, diff)
+
+
+def l2_many_to_many(xs: ArrayLike, ys: ArrayLike) -> np.ndarray:
+    """
+    :return: (m, n) distances between every row of xs and every row of ys
+    """
+    xs = _as_array(xs)
+    ys = _as_array(ys)
+
+    # |x - y|^2 = |x|^2 + |y|^2 - 2 x.y, clipped as rounding can make it slightly negative
+    distances = (xs * xs).sum(axis=1)[:, None] + (ys * ys).sum(axis=1)[None, :] - 2 * xs @ ys.T
+    return np.maximum(distances, 0)
+
+
+def l2_consecutive(xs: ArrayLike) -> np.ndarray:
+    """
+    :return: (n - 1,) distances between each row of xs and the row before it
+    """
+    xs = _as_array(xs)
+    diff = xs[1:] - xs[:-1]
+    return np.einsum('ij,ij->i', diff, diff)
+
+
+def cosine_one_to_many(x: ArrayLike, ys: ArrayLike, normalized: bool = False) -> np.ndarray:
+    """
+    :param normalized: x and ys are already L2-normalized
+    :return: (n,) distances from x to every row of ys
+    """
+    return cosine_many_to_many(_as_array(x)[None, :], ys, normalized)[0]
+
+
+def cosine_many_to_many(xs: ArrayLike, ys: ArrayLike, normalized: bool = False) -> np.ndarray:
+    """
+    :param normalized: xs and ys are already L2-normalized
+    :return: (m, n) distances between every row of xs and every row of ys
+    """
+    xs = _as_array(xs)
+    ys = _as_array(ys)
+
+    if not normalized:
+        xs = _normalize(xs)
+        ys = _normalize(ys)
+
+    return 1 - xs @ ys.T
+
+
+def cosine_consecutive(xs: ArrayLike, normalized: bool = False) -> np.ndarray:
+    """
+    :param normalized: the rows of xs are already L2-normalized
+    :return: (n - 1,) distances between each row of xs and the row before it
+    """
+    xs = _as_array(xs)
+
+    if not normalized:
+        xs = _normalize(xs)
+
+    return 1 - np.einsum('ij,ij->i', xs[1:], xs[:-1])
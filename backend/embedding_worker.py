@@ -0,0 +1,85 @@
+"""
+Optional separate process holding the CLIP model
+
+With EMBEDDING_WORKER_URL set, the search server sends its text and image queries to this worker
+instead of loading CLIP itself, so it starts without importing torch and a restart of the web
+server does not reload the model. Without it the queries are encoded in-process by utils.
+
+usage (from backend/): python embedding_worker.py [--port 5001] [--preload]
+                       EMBEDDING_WORKER_URL=http://127.0.0.1:5001 python server.py
+"""
+import os
+import argparse
+from io import BytesIO
+from typing import Callable, List
+
+import requests
+from PIL import Image
+from flask import Flask, request, jsonify
+
+import utils
+
+EMBEDDING_WORKER_URL = os.environ.get('EMBEDDING_WORKER_URL')
+
+# Seconds to wait for the worker, the first request may have to load the model
+EMBEDDING_WORKER_TIMEOUT = 120
+
+_session = requests.Session()
+
+
+# --------------------------- Client
+def encode_texts(texts: List[str]) -> List[List[float]]:
+    if not EMBEDDING_WORKER_URL:
+        return utils.encode_texts(texts)
+
+    response = _session.post(f'{EMBEDDING_WORKER_URL}/encode/text', json={'texts': texts},
+                             timeout=EMBEDDING_WORKER_TIMEOUT)
+    response.raise_for_status()
+    return response.json()['vectors']
+
+
+def encode_image_bytes(image_bytes: bytes, decode: Callable[[bytes], Image]) -> List[float]:
+    """
+    :param image_bytes: encoded image, sent to the worker as is
+    :param decode: turns the bytes into a PIL image when encoding in-process
+    """
+    if not EMBEDDING_WORKER_URL:
+        return utils.encode_image(decode(image_bytes))
+
+    response = _session.post(f'{EMBEDDING_WORKER_URL}/encode/image', data=image_bytes,
+                             headers={'Content-Type': 'application/octet-stream'}, timeout=EMBEDDING_WORKER_TIMEOUT)
+    response.raise_for_status()
+    return response.json()['vector']
+
+
+# --------------------------- Worker
+app = Flask(__name__)
+
+
+@app.route('/encode/text', methods=['POST'])
+def encode_text_route():
+    return jsonify({
+        'vectors': utils.encode_texts(request.get_json()['texts'])
+    })
+
+
+@app.route('/encode/image', methods=['POST'])
+def encode_image_route():
+    return jsonify({
+        'vector': utils.encode_image(Image.open(BytesIO(request.get_data())))
+    })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--preload', action='store_true', help='load both CLIP towers before serving')
+    args = parser.parse_args()
+
+    if args.preload:
+        from models import get_clip, get_clip_text, get_clip_image
+        get_clip()
+        get_clip_text()
+        get_clip_image()
+
+    app.run(host="127.0.0.1", port=args.port, debug=False, threaded=True)
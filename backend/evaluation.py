@@ -1,106 +1,192 @@
+import os
+import time
+import argparse
 from typing import List
+from contextlib import contextmanager
 
+import numpy as np
 import pandas
 import pandas as pd
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, precision_recall_fscore_support, confusion_matrix
-from postgres_db import connect_to_db
-from utils import encode_text
-from constants import YOLO_CLASSES
+from insert_to_db import get_video_data
+from utils import encode_texts
+from distance import cosine_many_to_many
 
 VIDEO_ID = "00184"
 SELECTED_OBJECTS = ["bicycle", "person", "car", "boat", "bench"]
 
-conn = connect_to_db()
-cursor = conn.cursor()
+# maxTextSimilarity used for the CLIP predictions
+CLIP_THRESHOLD = 0.875
+SWEEP_THRESHOLDS = np.round(np.arange(0.70, 0.95, 0.0025), 4)
+
+GROUND_TRUTH_FILE = "evaluations/evaluation_true_{video_id}.csv"
 
 
 # --------------------------- Prediction
-def text_query(query: str):
-    # For CLIP evaluation
-    encoded_query = encode_text(query)
+class Timer:
+    """
+    Records the wall time of named phases
+    """
 
-    cursor.execute(f"""
-        SELECT frame_id FROM frames
-        WHERE 
-            video_id = '{VIDEO_ID}'
-        AND
-            image_vector <=> %s::vector < 0.875
-    """, (encoded_query,))
+    def __init__(self):
+        self.times = {}
 
-    return [item[0] for item in cursor.fetchall()]
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        yield
+        self.times[name] = self.times.get(name, 0) + time.perf_counter() - start
 
+    def print(self):
+        print()
+        print("Phase, Time (s)")
+        for name, t in self.times.items():
+            print(f"{name} -> {t:.3f}")
 
-def object_query(obj: str):
-    # For YoloV8x evaluation
-    if obj not in YOLO_CLASSES:
-        raise Exception("Invalid object")
 
-    cursor.execute(f"""
-        SELECT frame_id FROM frames
-        WHERE 
-            video_id = '{VIDEO_ID}'
-        AND
-            objects && ARRAY{[obj]}::text[]
-    """)
+def load_frames(video_ids: List[str]):
+    """
+    Loads the frames of the videos once, the same frames insert_to_db loads into the database
 
-    return [item[0] for item in cursor.fetchall()]
+    :return: frame ids(list[str]), video ids(list[str]), image vectors(np.ndarray), objects(list[list[str]])
+    """
+    frame_ids, frame_video_ids, vectors, objects = [], [], [], []
 
+    for video_id in video_ids:
+        for vid, frame_id, objs, image_vector, _, _, _ in get_video_data(video_id):
+            frame_ids.append(frame_id)
+            frame_video_ids.append(vid)
+            vectors.append(image_vector)
+            objects.append(objs)
 
-def get_video_frames():
-    cursor.execute(f"""
-        SELECT frame_id FROM frames
-        WHERE video_id = '{VIDEO_ID}'
-    """)
+    return frame_ids, frame_video_ids, np.array(vectors, dtype=np.float32).reshape(-1, 768), objects
 
-    return [item[0] for item in cursor.fetchall()]
 
+def label_distances(vectors: np.ndarray, labels: List[str]) -> np.ndarray:
+    """
+    Cosine distance between every frame and the CLIP prompt of every label, one matmul
 
-def CLIP_evaluation():
-    data = []
-    for fid in get_video_frames():
-        data.append({
-            "id": fid,
-        })
+    :return: (frames, labels) distances
+    """
+    prompts = encode_texts([f"a photo of an {label}" for label in labels])
+    return cosine_many_to_many(vectors, prompts)
 
-    for obj in SELECTED_OBJECTS:
-        frames = text_query(f"a photo of an {obj}")
 
-        for item in data:
-            item[obj] = item["id"] in frames
+def yolo_predictions(objects: List[List[str]], labels: List[str]) -> np.ndarray:
+    """
+    :return: (frames, labels) bool, whether YOLO detected the label in the frame
+    """
+    return np.array([[label in set(objs) for label in labels] for objs in objects], dtype=bool).reshape(-1, len(labels))
 
-    items = []
-    keys = None
-    for item in data:
-        items.append(item.values())
-        keys = item.keys()
 
-    df = pandas.DataFrame(data=items, columns=keys)
-    df = df.set_index("id")
-    df.to_csv(f"evaluation_CLIP_{VIDEO_ID}.csv")
+def predictions_to_csv(frame_ids: List[str], labels: List[str], predictions: np.ndarray, file: str):
+    df = pandas.DataFrame(data=predictions, index=pd.Index(frame_ids, name="id"), columns=labels)
+    df.to_csv(file)
 
 
-def YOLO_evaluation():
-    data = []
-    for fid in get_video_frames():
-        data.append({
-            "id": fid,
-        })
+def CLIP_evaluation(video_id: str = VIDEO_ID, threshold: float = CLIP_THRESHOLD):
+    frame_ids, _, vectors, _ = load_frames([video_id])
+    predictions = label_distances(vectors, SELECTED_OBJECTS) < threshold
 
-    for obj in SELECTED_OBJECTS:
-        frames = object_query(obj)
+    predictions_to_csv(frame_ids, SELECTED_OBJECTS, predictions, f"evaluation_CLIP_{video_id}.csv")
+
+
+def YOLO_evaluation(video_id: str = VIDEO_ID):
+    frame_ids, _, _, objects = load_frames([video_id])
+    predictions = yolo_predictions(objects, SELECTED_OBJECTS)
+
+    predictions_to_csv(frame_ids, SELECTED_OBJECTS, predictions, f"evaluation_YOLO_{video_id}.csv")
+
+
+# --------------------------- Threshold sweep
+def load_ground_truth(frame_ids: List[str], frame_video_ids: List[str], labels: List[str]):
+    """
+    :return: mask of the frames that have ground truth, (frames with ground truth, labels) bool labels
+    """
+    truth = {}
+    for video_id in sorted(set(frame_video_ids)):
+        file = GROUND_TRUTH_FILE.format(video_id=video_id)
+        if os.path.exists(file):
+            gt = load_csv(file)
+            for fid, row in gt[labels].iterrows():
+                truth[(video_id, fid)] = row.to_numpy(dtype=bool)
+
+    keys = list(zip(frame_video_ids, frame_ids))
+    mask = np.array([k in truth for k in keys], dtype=bool)
+
+    return mask, np.array([truth[k] for k in keys if k in truth], dtype=bool).reshape(-1, len(labels))
+
+
+def precision_recall(predictions: np.ndarray, truth: np.ndarray):
+    """
+    :param predictions: (frames, labels, ...) bool
+    :param truth: (frames, labels) bool
+    :return: precision, recall, f1 with shape (labels, ...)
+    """
+    truth = truth.reshape(truth.shape + (1,) * (predictions.ndim - 2))
 
-        for item in data:
-            item[obj] = item["id"] in frames
+    tp = (predictions & truth).sum(axis=0)
+    fp = (predictions & ~truth).sum(axis=0)
+    fn = (~predictions & truth).sum(axis=0)
 
-    items = []
-    keys = None
-    for item in data:
-        items.append(item.values())
-        keys = item.keys()
+    precision = np.divide(tp, tp + fp, out=np.zeros(tp.shape), where=(tp + fp) > 0)
+    recall = np.divide(tp, tp + fn, out=np.zeros(tp.shape), where=(tp + fn) > 0)
+    f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros(tp.shape), where=(precision + recall) > 0)
+
+    return precision, recall, f1
+
+
+def sweep(video_ids: List[str], labels: List[str] = SELECTED_OBJECTS, thresholds: np.ndarray = SWEEP_THRESHOLDS,
+          out_file: str = "evaluation_sweep_CLIP.csv"):
+    """
+    Scores CLIP over all thresholds and YOLO on the frames of the videos that have ground truth.
+    Writes the precision / recall curve of every label to out_file and prints the best F1 operating points
+    """
+    timer = Timer()
+
+    with timer.phase("load frames"):
+        frame_ids, frame_video_ids, vectors, objects = load_frames(video_ids)
+        mask, truth = load_ground_truth(frame_ids, frame_video_ids, labels)
+
+    print(f"{len(frame_ids)} frames, {mask.sum()} with ground truth")
+
+    with timer.phase("encode labels + similarity matrix"):
+        distances = label_distances(vectors[mask], labels)
+
+    with timer.phase("threshold sweep"):
+        # (frames, labels, thresholds)
+        predictions = distances[:, :, None] < thresholds[None, None, :]
+        precision, recall, f1 = precision_recall(predictions, truth)
+
+    with timer.phase("YOLO"):
+        yolo = yolo_predictions([o for o, m in zip(objects, mask) if m], labels)
+        yolo_precision, yolo_recall, yolo_f1 = precision_recall(yolo, truth)
+
+    rows = []
+    for i, label in enumerate(labels):
+        for j, t in enumerate(thresholds):
+            rows.append({"label": label, "threshold": t, "precision": precision[i, j], "recall": recall[i, j],
+                         "f1": f1[i, j]})
+    pd.DataFrame(rows).to_csv(out_file, index=False)
+
+    print()
+    print("Label, CLIP best threshold, Precision, Recall, F1 | YOLO Precision, Recall, F1")
+    for i, label in enumerate(labels):
+        j = int(np.argmax(f1[i]))
+        print(f"{label} -> {thresholds[j]}, {precision[i, j]:.3f}, {recall[i, j]:.3f}, {f1[i, j]:.3f} | "
+              f"{yolo_precision[i]:.3f}, {yolo_recall[i]:.3f}, {yolo_f1[i]:.3f}")
+
+    # One threshold shared by all labels, as maxTextSimilarity is
+    micro_tp = (predictions & truth[:, :, None]).sum(axis=(0, 1))
+    micro_predicted = predictions.sum(axis=(0, 1))
+    micro_true = truth.sum()
+    micro_f1 = np.divide(2 * micro_tp, micro_predicted + micro_true, out=np.zeros(len(thresholds)),
+                         where=(micro_predicted + micro_true) > 0)
+    j = int(np.argmax(micro_f1))
+    print()
+    print(f"Best shared threshold (micro F1): {thresholds[j]} -> {micro_f1[j]:.3f}")
 
-    df = pandas.DataFrame(data=items, columns=keys)
-    df = df.set_index("id")
-    df.to_csv(f"evaluation_YOLO_{VIDEO_ID}.csv")
+    timer.print()
 
 
 # --------------------------- Evaluation
@@ -147,5 +233,13 @@ def evaluate_results(pred_file: str, gt_file: str):
 
 
 if __name__ == "__main__":
-    evaluate_results("evaluations/evaluation_CLIP_00184.csv", "evaluations/evaluation_true_00184.csv")
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sweep', nargs='+', default=None, metavar='VIDEO_ID',
+                        help='sweep the CLIP threshold over these videos instead of scoring the saved CSVs')
+    args = parser.parse_args()
+
+    if args.sweep:
+        sweep(args.sweep)
+    else:
+        evaluate_results("evaluations/evaluation_CLIP_00184.csv", "evaluations/evaluation_true_00184.csv")
 
@@ -1,133 +1,318 @@
 import os
-import json
+import shutil
 import subprocess
 import cv2 as cv
 import numpy as np
 from PIL import Image
 
-from utils import get_video_ids, encode_image, get_objects_in_image, get_image_colors, find_middle_timestamps, \
-    compress_video, get_text_in_image
+from utils import encode_images, get_objects_in_images, get_image_colors, find_middle_timestamps, \
+    get_text_in_images, COMPRESS_ARGS
+from feature_store import write_video_features
+from near_duplicates import FrameDeduplicator
+from metrics import timer, timed_iter
 from constants import DATA_DIR
 
 SHOT_CHANGE_THRESHOLD = 2
 
+# Number of keyframes sent through each model in a single forward pass
+ANALYSIS_BATCH_SIZE = 16
 
-def generate_shot_change_info(video_id: str):
+# Keyframe decoding: 'seek' jumps to each target frame, 'grab' skips frames without decoding them,
+# 'read' decodes every frame (original behaviour, kept for benchmarking)
+DECODE_MODE = 'seek'
+# Targets closer than this many frames are reached with grab() rather than a seek
+SEEK_MIN_GAP = 50
+
+
+class FFmpegInfo:
+    """
+    Collects the shot changes and duration from ffmpeg's log output, one line at a time.
+    The frame rate is not taken from the log, ffmpeg prints it rounded (23.98 for 24000/1001)
+    """
+
+    def __init__(self):
+        self.shot_change_ts = [0]
+        self.video_duration = -1
+
+    def parse_line(self, l: str):
+        if 'lavfi.scd.score' in l and 'lavfi.scd.time' in l:
+            contents = l.split('lavfi.scd.time:')
+            self.shot_change_ts.append(float(contents[1].strip().replace('\n', '')))
+
+        elif 'Duration' in l and self.video_duration == -1:
+            contents = l.split('Duration: ')[1].split(',')[0].split(':')
+            contents = [float(c) for c in contents]
+            self.video_duration = (contents[0] * 60 + contents[1]) * 60 + contents[2]
+
+    def keyframe_timestamps(self) -> list[float]:
+        return find_middle_timestamps(self.shot_change_ts + [self.video_duration])
+
+
+def _get_fps(video_path: str) -> float:
+    # Exact frame rate of the container, only the header is read, nothing is decoded
+    cap = cv.VideoCapture(video_path)
+    fps = cap.get(cv.CAP_PROP_FPS)
+    cap.release()
+
+    return fps
+
+
+def process_video(video_id: str, compress: bool = True):
     """
-    Runs the shot change detection filter on the video
+    Single ffmpeg pass over the video: runs the shot change detection filter into a null output
+    and, in the same run, encodes the compressed rendition.
+    The log is parsed as ffmpeg writes it, nothing is written to disk besides the compressed video
 
     :param video_id: name of file in the dataset without the extension
-    :return: relative path to the video and the ffmpeg output
+    :param compress: also write {video_id}_compressed.mp4
+    :return: path to the video, fps(float), timeperiod(float), videoDuration(float), keyframe timestamps(list[float])
     """
     src_path = os.path.join(DATA_DIR, video_id, f'{video_id}.mp4')
-    target_path = os.path.join(DATA_DIR, video_id, f'{video_id}_shot.mp4')
+    target_path = os.path.join(DATA_DIR, video_id, f'{video_id}_compressed.mp4')
 
     # https://ffmpeg.org/ffmpeg-filters.html#scdet-1
-    ffmpeg_cmd = f'ffmpeg -i {src_path} -vf "scdet=s=0:t={SHOT_CHANGE_THRESHOLD}" {target_path}'
-    ffmpeg_result = subprocess.getoutput(ffmpeg_cmd)
+    scdet = f'scdet=s=0:t={SHOT_CHANGE_THRESHOLD}'
+
+    if compress:
+        ffmpeg_cmd = ['ffmpeg', '-y', '-i', src_path,
+                      '-filter_complex', f'[0:v]split=2[shot][out];[shot]{scdet}[scd]',
+                      '-map', '[scd]', '-f', 'null', '-',
+                      '-map', '[out]', '-map', '0:a?'] + COMPRESS_ARGS + [target_path]
+    else:
+        ffmpeg_cmd = ['ffmpeg', '-i', src_path, '-vf', scdet, '-an', '-f', 'null', '-']
+
+    info = FFmpegInfo()
 
-    out = os.path.join(DATA_DIR, video_id, 'ffmpeg_out.txt')
-    with open(out, 'w') as f:
-        f.write(ffmpeg_result)
+    # Shot detection and compression share the decode, they are timed together
+    with timer('shot_detection'), \
+            subprocess.Popen(ffmpeg_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+                             errors='replace') as proc:
+        for l in proc.stderr:
+            info.parse_line(l)
 
-    # Removes the output file from the ffmpeg cmd
-    os.remove(target_path)
+    if proc.returncode != 0:
+        raise Exception(f"ffmpeg exited with {proc.returncode} for {video_id}")
 
-    return src_path, out
+    fps = _get_fps(src_path)
+
+    return src_path, fps, 1 / fps, info.video_duration, info.keyframe_timestamps()
 
 
 def get_video_info(video_path: str, ffmpeg_info_file: str):
     """
-    Extracts metadata and shot change timestamp
+    Extracts metadata and shot change timestamp from a saved ffmpeg output
 
     :param video_path: path to the source video in the dataset
     :param ffmpeg_info_file: path to the ffmpeg shot change detection filter cmd outfile
     :return: fps(float), timeperiod(float), videoDuration(float), timestamps of shot change(list[float])
     """
-    shot_change_ts = [0]
-    video_duration = -1
+    info = FFmpegInfo()
 
     with open(ffmpeg_info_file, 'r') as f:
-        for l in f.readlines():
-            if 'lavfi.scd.score' in l and 'lavfi.scd.time' in l:
-                contents = l.split('lavfi.scd.time:')
-                shot_change_ts.append(float(contents[1].strip().replace('\n', '')))
-
-            if 'Duration' in l:
-                contents = l.split('Duration: ')[1].split(',')[0].split(':')
-                contents = [float(c) for c in contents]
-                video_duration = (contents[0] * 60 + contents[1]) * 60 + contents[2]
+        for l in f:
+            info.parse_line(l)
 
-    shot_change_ts.append(video_duration)
-
-    cap = cv.VideoCapture(video_path)
-    fps = cap.get(cv.CAP_PROP_FPS)
+    fps = _get_fps(video_path)
     timeperiod = 1 / fps
 
-    cap.release()
+    return fps, timeperiod, info.video_duration, info.keyframe_timestamps()
 
-    return fps, timeperiod, video_duration, find_middle_timestamps(shot_change_ts)
 
+def analyse_keyframes(keyframes: list[tuple[int, float, Image.Image]]):
+    """
+    Runs CLIP, YOLO, OCR and the color extraction over a batch of keyframes,
+    one forward pass per model for the whole batch
 
-def generate_keyframes(video_path: str, video_id: str, timeperiod: float, keyframe_ts: list[float]):
-    frames_dir = os.path.join(DATA_DIR, video_id, 'frames')
-    os.makedirs(frames_dir)
+    :param keyframes: list of (frame_id, timestamp, image)
+    :return: list of keyframe data dicts, in the same order as keyframes
+    """
+    images = [img for _, _, img in keyframes]
 
-    frame_id = 1
-    timestamps = keyframe_ts
-    current_ts = 0
-    cap = cv.VideoCapture(video_path)
+    with timer('clip'):
+        img_vecs = encode_images(images)
+    with timer('yolo'):
+        img_objs = get_objects_in_images(images)
+    with timer('ocr'):
+        txts = get_text_in_images(images)
 
     data = []
+    for (frame_id, timestamp, img), img_vec, objs, txt in zip(keyframes, img_vecs, img_objs, txts):
+        with timer('colors'):
+            dominant_colors, red, green, blue = get_image_colors(img)
+
+        data.append({
+            'frame_id': f'frame_{frame_id}',
+            'timestamp': timestamp,
+            'image_vector': img_vec,
+            'objects': objs,
+            'text': txt,
+            'histogram': {
+                'red': red,
+                'green': green,
+                'blue': blue
+            },
+            'dominant_colors': dominant_colors
+        })
+
+    return data
+
+
+def keyframe_indices(fps: float, keyframe_ts: list[float]) -> list[int]:
+    """
+    Maps keyframe timestamps to 0-based frame indices.
+    The selected frame is the first one whose end time ((index + 1) / fps) is past the timestamp
+
+    :param fps: frames per second of the video
+    :param keyframe_ts: sorted timestamps in seconds
+    :return: frame index per timestamp
+    """
+    indices = []
+    for ts in keyframe_ts:
+        index = int(np.floor(ts * fps))
+        # Each decoded frame serves at most one timestamp
+        if indices and index <= indices[-1]:
+            index = indices[-1] + 1
+        indices.append(index)
+
+    return indices
+
 
-    while cap.isOpened():
-        if len(timestamps) == 0:
-            break
+def _decode_read(cap: cv.VideoCapture, indices: list[int]):
+    position = 0
+    for index in indices:
+        while position <= index:
+            can_read, frame = cap.read()
+            if not can_read:
+                return
+            position += 1
+
+        yield index, frame
+
+
+def _decode_grab(cap: cv.VideoCapture, indices: list[int], position: int = 0):
+    for index in indices:
+        while position < index:
+            if not cap.grab():
+                return
+            position += 1
 
         can_read, frame = cap.read()
+        if not can_read:
+            return
+        position += 1
+
+        yield index, frame
+
+
+def _decode_seek(cap: cv.VideoCapture, indices: list[int]):
+    position = 0
+    for i, index in enumerate(indices):
+        if index - position >= SEEK_MIN_GAP:
+            cap.set(cv.CAP_PROP_POS_FRAMES, index)
+
+            if int(cap.get(cv.CAP_PROP_POS_FRAMES)) != index:
+                # Container does not support accurate seeking, continue without seeking
+                print(f"Inaccurate seek @ frame {index}, falling back to grab")
+                cap.set(cv.CAP_PROP_POS_FRAMES, 0)
+                yield from _decode_grab(cap, indices[i:])
+                return
+
+            position = index
+
+        can_read = False
+        for decoded in _decode_grab(cap, [index], position):
+            can_read = True
+            yield decoded
 
         if not can_read:
-            print(f"Unable to read video @ {current_ts}, source: {video_path}")
-            break
-
-        current_ts += timeperiod
-        if current_ts > timestamps[0]:
-            timestamps.pop(0)
-            frame = cv.cvtColor(frame, cv.COLOR_RGB2BGR)
-            img = Image.fromarray(np.uint8(frame))
+            return
+        position = index + 1
+
+
+def decode_keyframes(video_path: str, fps: float, keyframe_ts: list[float], mode: str = DECODE_MODE):
+    """
+    Decodes only the frames at the keyframe timestamps
+
+    :param video_path: path to the source video
+    :param fps: frames per second of the video
+    :param keyframe_ts: sorted timestamps in seconds
+    :param mode: 'seek', 'grab' or 'read'
+    :return: yields timestamp(float), frame(np.ndarray, RGB)
+    """
+    decoders = {
+        'read': _decode_read,
+        'grab': _decode_grab,
+        'seek': _decode_seek,
+    }
+
+    if mode not in decoders:
+        raise Exception(f"Unknown decode mode {mode}")
+
+    cap = cv.VideoCapture(video_path)
+    indices = keyframe_indices(fps, keyframe_ts)
+
+    decoded = 0
+    try:
+        for index, frame in decoders[mode](cap, indices):
+            decoded += 1
+            # Timestamp derived from the frame index, summing the time period per frame drifts
+            yield (index + 1) / fps, cv.cvtColor(frame, cv.COLOR_BGR2RGB)
+    finally:
+        cap.release()
+
+    if decoded < len(indices):
+        print(f"Unable to read video @ frame {indices[decoded]}, source: {video_path}")
+
+
+def generate_keyframes(video_path: str, video_id: str, timeperiod: float, keyframe_ts: list[float],
+                       batch_size: int = ANALYSIS_BATCH_SIZE, decode_mode: str = DECODE_MODE, dedup: bool = True):
+    frames_dir = os.path.join(DATA_DIR, video_id, 'frames')
+    # Frames from an interrupted run are regenerated
+    shutil.rmtree(frames_dir, ignore_errors=True)
+    os.makedirs(frames_dir)
+
+    data = []
+    batch = []
+    deduplicator = FrameDeduplicator()
+
+    frames = timed_iter(decode_keyframes(video_path, 1 / timeperiod, keyframe_ts, decode_mode), 'decode')
+    # Every decoded keyframe takes an id, skipped ones too, so the ids of a video (and the ground truth of
+    # the evaluations keyed on them) do not depend on which frames are dropped
+    for frame_id, (timestamp, frame) in enumerate(frames, 1):
+        # Blank and near-duplicate frames are dropped before the models run on them
+        with timer('dedup'):
+            keep = not dedup or deduplicator.keep(frame)
+        if not keep:
+            continue
+
+        img = Image.fromarray(np.uint8(frame))
+        with timer('jpeg'):
             img.save(os.path.join(frames_dir, f'frame_{frame_id}.jpeg'))
 
-            img_vec = encode_image(img)
-            img_objs = get_objects_in_image(img)
-            dominant_colors, red, green, blue = get_image_colors(img)
-            txt = get_text_in_image(img)
-
-            data.append({
-                'frame_id': f'frame_{frame_id}',
-                'timestamp': current_ts,
-                'image_vector': img_vec,
-                'objects': img_objs,
-                'text': txt,
-                'histogram': {
-                    'red': red,
-                    'green': green,
-                    'blue': blue
-                },
-                'dominant_colors': dominant_colors
-            })
-
-            frame_id += 1
+        batch.append((frame_id, timestamp, img))
+        if len(batch) >= batch_size:
+            data += analyse_keyframes(batch)
+            batch = []
+
+    if batch:
+        data += analyse_keyframes(batch)
+
+    if deduplicator.skipped:
+        print(f"{video_id}: skipped {deduplicator.skipped} blank or duplicate keyframes")
 
     return data
 
 
+def write_video_data(video_id: str, fps: float, duration: float, keyframe_data: list[dict]):
+    with timer('features'):
+        write_video_features(video_id, fps, duration, keyframe_data)
+
+
 def video00182():
     # For 00182
     # ffmpeg -i V3C1-100/00182/00182.mov -vf "scdet=s=0:t=2" V3C1-100/00182/00182_shot.mov > output.txt 2>&1
     # copy and paste the contents of output.txt to a new file .txt file, encoding error
     # f"ffmpeg -i V3C1-100/00182/00182.mov -vcodec libx264 -acodec aac -ac 1 -crf 35 V3C1-100/00182/00182_compressed.mp4"
-    video_data = {}
-
     video_id = "00182"
     video_path = "V3C1-100/00182/00182.mov"
     ffmpeg_info_file = "V3C1-100/00182/ffmpeg_out.txt"
@@ -135,34 +320,16 @@ def video00182():
     fps, timeperiod, duration, keyframe_ts = get_video_info(video_path, ffmpeg_info_file)
     keyframe_data = generate_keyframes(video_path, video_id, timeperiod, keyframe_ts)
 
-    video_data['video_id'] = video_id
-    video_data['fps'] = fps
-    video_data['duration'] = duration
-    video_data['num_keyframes'] = len(keyframe_data)
-    video_data['keyframes'] = keyframe_data
-
-    with open(os.path.join(DATA_DIR, video_id, 'data.json'), 'w') as file:
-        file.write(json.dumps(video_data, indent=4))
+    write_video_data(video_id, fps, duration, keyframe_data)
 
 
 def extract_video_data(video_id: str):
     try:
-        video_data = {}
-
-        video_path, ffmpeg_info_file = generate_shot_change_info(video_id)
-        fps, timeperiod, duration, keyframe_ts = get_video_info(video_path, ffmpeg_info_file)
+        video_path, fps, timeperiod, duration, keyframe_ts = process_video(video_id)
         keyframe_data = generate_keyframes(video_path, video_id, timeperiod, keyframe_ts)
 
-        video_data['video_id'] = video_id
-        video_data['fps'] = fps
-        video_data['duration'] = duration
-        video_data['num_keyframes'] = len(keyframe_data)
-        video_data['keyframes'] = keyframe_data
+        write_video_data(video_id, fps, duration, keyframe_data)
 
-        with open(os.path.join(DATA_DIR, video_id, 'data.json'), 'w') as file:
-            file.write(json.dumps(video_data, indent=4))
-
-        compress_video(video_id)
         print(video_id)
 
     except Exception as e:
@@ -171,13 +338,6 @@ def extract_video_data(video_id: str):
 
 
 if __name__ == '__main__':
-
-    ids = get_video_ids()
-
-    ctr = 0
-    for vid in ids:
-        ctr += 1
-        print(f"[{ctr} / {len(ids)}]")
-        extract_video_data(vid)    
-
-    video00182()
+    # Parallel and resumable, see ingest.py
+    from ingest import main
+    main()
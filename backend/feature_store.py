@@ -0,0 +1,151 @@
+"""
+Binary per-video storage of the keyframe features
+
+{DATA_DIR}/{video_id}/features/
+    image_vectors.npy     (num_keyframes, 768)     float32 or float16
+    histograms.npy        (num_keyframes, 3, 256)  uint32, red / green / blue
+    dominant_colors.npy   (num_keyframes, 10, 3)   uint8, padded, see num_colors in meta.json
+    meta.json             video info and the per-keyframe frame_id, timestamp, objects, text, num_colors
+
+The arrays are memory-mapped on load, nothing is parsed besides the small metadata sidecar.
+"""
+import os
+import json
+import numpy as np
+from dataclasses import dataclass
+
+from utils import get_video_ids
+from constants import DATA_DIR
+
+FEATURES_DIR = 'features'
+NUM_DOMINANT_COLORS = 10
+# Size of the CLIP ViT-L/14 image embeddings
+VECTOR_DIM = 768
+
+# float16 halves the size of the embeddings, cosine distances change by ~1e-3
+VECTOR_DTYPE = os.environ.get('FEATURE_VECTOR_DTYPE', 'float32')
+
+
+@dataclass
+class VideoFeatures:
+    video_id: str
+    fps: float
+    duration: float
+    image_vectors: np.ndarray
+    histograms: np.ndarray
+    dominant_colors: np.ndarray
+    keyframes: list[dict]
+
+    def __len__(self):
+        return len(self.keyframes)
+
+    def colors(self, i: int) -> list[list[int]]:
+        """
+        Dominant colors of the i-th keyframe without the padding
+        """
+        return self.dominant_colors[i, :self.keyframes[i]['num_colors']].tolist()
+
+
+def features_dir(video_id: str) -> str:
+    return os.path.join(DATA_DIR, video_id, FEATURES_DIR)
+
+
+def has_features(video_id: str) -> bool:
+    return os.path.exists(os.path.join(features_dir(video_id), 'meta.json'))
+
+
+def write_video_features(video_id: str, fps: float, duration: float, keyframe_data: list[dict],
+                         vector_dtype: str = VECTOR_DTYPE):
+    """
+    Writes the keyframe data produced by extract_data.analyse_keyframes
+
+    :param video_id: name of file in the dataset without the extension
+    :param fps: frames per second of the video
+    :param duration: duration of the video in seconds
+    :param keyframe_data: list of keyframe data dicts
+    :param vector_dtype: 'float32' or 'float16'
+    """
+    out_dir = features_dir(video_id)
+    os.makedirs(out_dir, exist_ok=True)
+
+    n = len(keyframe_data)
+    if n == 0:
+        # Very short or unreadable videos have no keyframes, the arrays still need their shape
+        image_vectors = np.empty((0, VECTOR_DIM), dtype=vector_dtype)
+        histograms = np.empty((0, 3, 256), dtype=np.uint32)
+    else:
+        image_vectors = np.array([k['image_vector'] for k in keyframe_data], dtype=vector_dtype).reshape(n, -1)
+        histograms = np.array([[k['histogram']['red'], k['histogram']['green'], k['histogram']['blue']]
+                               for k in keyframe_data], dtype=np.uint32).reshape(n, 3, 256)
+
+    dominant_colors = np.zeros((n, NUM_DOMINANT_COLORS, 3), dtype=np.uint8)
+    for i, k in enumerate(keyframe_data):
+        if k['dominant_colors']:
+            dominant_colors[i, :len(k['dominant_colors'])] = k['dominant_colors']
+
+    np.save(os.path.join(out_dir, 'image_vectors.npy'), image_vectors)
+    np.save(os.path.join(out_dir, 'histograms.npy'), histograms)
+    np.save(os.path.join(out_dir, 'dominant_colors.npy'), dominant_colors)
+
+    meta = {
+        'video_id': video_id,
+        'fps': fps,
+        'duration': duration,
+        'num_keyframes': n,
+        'keyframes': [{
+            'frame_id': k['frame_id'],
+            'timestamp': k['timestamp'],
+            'objects': k['objects'],
+            'text': k['text'],
+            'num_colors': len(k['dominant_colors'])
+        } for k in keyframe_data]
+    }
+
+    # meta.json marks the features as complete, so it is written last
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def load_video_features(video_id: str, mmap: bool = True) -> VideoFeatures:
+    """
+    Loads the features of a video
+
+    :param video_id: name of file in the dataset without the extension
+    :param mmap: memory-map the arrays instead of reading them into memory
+    :return: VideoFeatures
+    """
+    in_dir = features_dir(video_id)
+    mmap_mode = 'r' if mmap else None
+
+    with open(os.path.join(in_dir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+
+    return VideoFeatures(
+        video_id=meta['video_id'],
+        fps=meta['fps'],
+        duration=meta['duration'],
+        image_vectors=np.load(os.path.join(in_dir, 'image_vectors.npy'), mmap_mode=mmap_mode),
+        histograms=np.load(os.path.join(in_dir, 'histograms.npy'), mmap_mode=mmap_mode),
+        dominant_colors=np.load(os.path.join(in_dir, 'dominant_colors.npy'), mmap_mode=mmap_mode),
+        keyframes=meta['keyframes']
+    )
+
+
+def convert_json(video_id: str, vector_dtype: str = VECTOR_DTYPE):
+    """
+    Converts the data.json of an already extracted video to the binary store
+    """
+    with open(os.path.join(DATA_DIR, video_id, 'data.json'), 'r') as file:
+        data = json.load(file)
+
+    write_video_features(video_id, data['fps'], data['duration'], data['keyframes'], vector_dtype)
+
+
+if __name__ == '__main__':
+    ids = get_video_ids()
+    ids.append("00182")
+
+    for vid in ids:
+        if not has_features(vid) and os.path.exists(os.path.join(DATA_DIR, vid, 'data.json')):
+            convert_json(vid)
+            print(vid)
@@ -0,0 +1,231 @@
+"""
+Parallel, resumable ingestion of the dataset
+
+Every video goes through STAGES in order. The completed stages and their outputs are recorded in
+{DATA_DIR}/{video_id}/manifest.json, so a re-run skips finished videos and resumes the others at the
+first stage that has not completed.
+
+usage (from backend/): python ingest.py [--workers 4] [--videos 00001 00002] [--retry-failed]
+"""
+import os
+import json
+import time
+import argparse
+import traceback
+from multiprocessing import Pool, cpu_count
+
+from utils import get_video_ids
+from extract_data import process_video, generate_keyframes, write_video_data, video00182
+from feature_store import has_features
+from thumbnails import generate_thumbnails
+import metrics
+from constants import DATA_DIR
+
+STAGES = ['ffmpeg', 'keyframes', 'thumbnails']
+
+MANIFEST_FILE = 'manifest.json'
+
+
+# --------------------------- Manifest
+def manifest_path(video_id: str) -> str:
+    return os.path.join(DATA_DIR, video_id, MANIFEST_FILE)
+
+
+def load_manifest(video_id: str) -> dict:
+    try:
+        with open(manifest_path(video_id), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {'video_id': video_id, 'stages': {}, 'error': None}
+
+
+def save_manifest(manifest: dict):
+    # Written to a temporary file first so an interrupted write never leaves a corrupt manifest
+    path = manifest_path(manifest['video_id'])
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+
+def is_complete(manifest: dict) -> bool:
+    return all([stage in manifest['stages'] for stage in STAGES])
+
+
+# --------------------------- Stages
+def stage_ffmpeg(video_id: str, manifest: dict) -> dict:
+    video_path, fps, timeperiod, duration, keyframe_ts = process_video(video_id)
+
+    return {
+        'video_path': video_path,
+        'fps': fps,
+        'duration': duration,
+        'keyframe_ts': keyframe_ts
+    }
+
+
+def stage_keyframes(video_id: str, manifest: dict) -> dict:
+    info = manifest['stages']['ffmpeg']
+
+    keyframe_data = generate_keyframes(info['video_path'], video_id, 1 / info['fps'], list(info['keyframe_ts']))
+    write_video_data(video_id, info['fps'], info['duration'], keyframe_data)
+
+    return {
+        'num_keyframes': len(keyframe_data)
+    }
+
+
+def stage_thumbnails(video_id: str, manifest: dict) -> dict:
+    with metrics.timer('thumbnails'):
+        num_thumbnails = generate_thumbnails(video_id)
+
+    return {
+        'num_thumbnails': num_thumbnails
+    }
+
+
+STAGE_FUNCTIONS = {
+    'ffmpeg': stage_ffmpeg,
+    'keyframes': stage_keyframes,
+    'thumbnails': stage_thumbnails,
+}
+
+
+def ingest_video(video_id: str):
+    """
+    Runs the stages of one video that have not completed yet, recording each one in the manifest
+
+    :param video_id: name of file in the dataset without the extension
+    :return: video_id(str), success(bool), elapsed seconds(float), number of keyframes(int),
+             seconds per timed phase of this run(dict)
+    """
+    start = time.perf_counter()
+    manifest = load_manifest(video_id)
+
+    run_stages = []
+
+    try:
+        for stage in STAGES:
+            if stage in manifest['stages']:
+                continue
+
+            run_stages.append(stage)
+            with metrics.collect() as timings:
+                result = STAGE_FUNCTIONS[stage](video_id, manifest)
+
+            # Seconds spent in every timed phase of the stage (decode, clip, yolo, ocr, ...), see metrics.py
+            result['timings'] = timings
+            manifest['stages'][stage] = result
+            manifest['error'] = None
+            save_manifest(manifest)
+
+    except Exception as e:
+        manifest['error'] = {
+            'stage': stage,
+            'message': str(e),
+            'traceback': traceback.format_exc()
+        }
+        save_manifest(manifest)
+
+        return video_id, False, time.perf_counter() - start, 0, {}
+
+    timings = {}
+    for stage in run_stages:
+        for phase, seconds in manifest['stages'][stage]['timings'].items():
+            timings[phase] = timings.get(phase, 0) + seconds
+
+    return video_id, True, time.perf_counter() - start, manifest['stages']['keyframes']['num_keyframes'], timings
+
+
+def _init_worker(num_threads: int):
+    import torch
+
+    # Keeps the workers from oversubscribing the cores
+    torch.set_num_threads(num_threads)
+
+
+# --------------------------- Scheduler
+def format_seconds(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def pending_videos(video_ids: list[str], retry_failed: bool) -> list[str]:
+    pending = []
+    for video_id in video_ids:
+        manifest = load_manifest(video_id)
+
+        if is_complete(manifest):
+            continue
+
+        if manifest['error'] is not None and not retry_failed:
+            print(f"Skipping {video_id}, failed in stage {manifest['error']['stage']}: {manifest['error']['message']}")
+            continue
+
+        pending.append(video_id)
+
+    return pending
+
+
+def run(video_ids: list[str], workers: int, retry_failed: bool = False):
+    pending = pending_videos(video_ids, retry_failed)
+    print(f"{len(video_ids) - len(pending)} / {len(video_ids)} videos already ingested, {len(pending)} pending")
+
+    if len(pending) == 0:
+        return
+
+    start = time.perf_counter()
+    done = 0
+    failed = []
+    keyframes = 0
+    timings = {}
+
+    with Pool(workers, initializer=_init_worker, initargs=(max(1, cpu_count() // workers),)) as pool:
+        for video_id, success, elapsed, num_keyframes, video_timings in pool.imap_unordered(ingest_video, pending):
+            done += 1
+            keyframes += num_keyframes
+            for phase, seconds in video_timings.items():
+                timings[phase] = timings.get(phase, 0) + seconds
+
+            if not success:
+                failed.append(video_id)
+                print(f'======================== ERROR @ {video_id}, see {manifest_path(video_id)} ========================')
+
+            total_elapsed = time.perf_counter() - start
+            rate = done / total_elapsed
+            eta = (len(pending) - done) / rate
+
+            print(f"[{done} / {len(pending)}] {video_id} in {elapsed:.1f}s | "
+                  f"{rate * 60:.2f} videos/min, {keyframes / total_elapsed:.2f} keyframes/s | "
+                  f"ETA {format_seconds(eta)}")
+
+    total_elapsed = time.perf_counter() - start
+    print()
+    print(f"Ingested {done - len(failed)} videos ({keyframes} keyframes) in {format_seconds(total_elapsed)}")
+    if failed:
+        print(f"{len(failed)} failed: {', '.join(sorted(failed))}")
+
+    # Summed over the workers, so the shares add up to 100% of the worker time, not the wall time
+    total = sum(timings.values())
+    if total > 0:
+        print()
+        print("Phase, Time (s), Share")
+        for phase, seconds in sorted(timings.items(), key=lambda t: -t[1]):
+            print(f"{phase} -> {seconds:.1f}, {seconds / total:.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=max(1, cpu_count() // 4))
+    parser.add_argument('--videos', nargs='+', default=None, help='subset of video ids, defaults to the whole dataset')
+    parser.add_argument('--retry-failed', action='store_true', help='retry videos whose last run failed')
+    args = parser.parse_args()
+
+    run(args.videos if args.videos else get_video_ids(), args.workers, args.retry_failed)
+
+    if args.videos is None and not has_features('00182'):
+        video00182()
+        generate_thumbnails('00182')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,38 @@
-import os
-import json
+import io
+import argparse
+import numpy as np
+from psycopg2.extras import execute_values
 from postgres_db import connect_to_db
 from utils import get_video_ids
-from distance import l2
-from constants import DATA_DIR
+from distance import l2, l2_consecutive
+from utils_server import pack_colors, color_bins
+from feature_store import load_video_features
+from near_duplicates import EmbeddingLSH
+from text_index import normalize_tokens
 
 
-# docker compose up
-def add_data_to_pg():
-    """
-    Adds the data to the database
-    """
-    conn = connect_to_db()
-    cursor = conn.cursor()
+# Rows sent per COPY
+COPY_BATCH_SIZE = 5000
+
+COLUMNS = ('id', 'video_id', 'frame_id', 'timestamp', 'objects', 'colors', 'color_codes', 'color_bins', 'image_vector',
+           'text', 'text_doc')
+
+INDEXES = {
+    'frames_video_id_idx': 'CREATE INDEX IF NOT EXISTS frames_video_id_idx ON frames (video_id, timestamp)',
+    'frames_image_vector_idx': 'CREATE INDEX IF NOT EXISTS frames_image_vector_idx ON frames USING hnsw (image_vector vector_cosine_ops)',
+    'frames_objects_idx': 'CREATE INDEX IF NOT EXISTS frames_objects_idx ON frames USING gin (objects)',
+    'frames_color_bins_idx': 'CREATE INDEX IF NOT EXISTS frames_color_bins_idx ON frames USING gin (color_bins)',
+    'frames_text_idx': 'CREATE INDEX IF NOT EXISTS frames_text_idx ON frames USING gin (text)',
+    'frames_text_trgm_idx': 'CREATE INDEX IF NOT EXISTS frames_text_trgm_idx ON frames USING gin (text_doc gin_trgm_ops)',
+}
 
+
+def create_table(cursor):
     cursor.execute("""
         CREATE EXTENSION IF NOT EXISTS vector;
+        -- Trigram index and levenshtein of the prefix and fuzzy word search, see text_index
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE EXTENSION IF NOT EXISTS fuzzystrmatch;
 
         CREATE TABLE IF NOT EXISTS frames (
           id text PRIMARY KEY,
@@ -27,57 +44,244 @@ def add_data_to_pg():
           image_vector vector(768),
           text text[]
         );
+
+        -- Dominant colors packed as 0xRRGGBB and their coarse bins, see utils_server
+        ALTER TABLE frames ADD COLUMN IF NOT EXISTS color_codes int[];
+        ALTER TABLE frames ADD COLUMN IF NOT EXISTS color_bins int[];
+        -- The normalized OCR tokens joined by spaces, for the trigram index
+        ALTER TABLE frames ADD COLUMN IF NOT EXISTS text_doc text;
     """)
 
-    for video_id, frame_id, objects, image_vector, dominant_colors, timestamp, text in get_data():
-        row_id = video_id + '-' + frame_id
+    normalize_text(cursor)
+
+
+def normalize_text(cursor):
+    """
+    Normalizes the OCR words of the rows loaded before text_doc existed, so they match the (normalized) word queries
+    without a reload
+    """
+    cursor.execute("SELECT id, text FROM frames WHERE text_doc IS NULL")
+    rows = [(id, normalize_tokens(text or [])) for id, text in cursor.fetchall()]
+
+    for i in range(0, len(rows), COPY_BATCH_SIZE):
+        execute_values(cursor, """
+            UPDATE frames SET text = v.text, text_doc = array_to_string(v.text, ' ')
+            FROM (VALUES %s) AS v (id, text) WHERE frames.id = v.id
+        """, rows[i:i + COPY_BATCH_SIZE], template='(%s, %s::text[])')
+
+    if rows:
+        print(f"Normalized the OCR words of {len(rows)} frames")
+
+
+def drop_indexes(cursor):
+    for name in INDEXES:
+        cursor.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+def create_indexes(cursor):
+    # HNSW builds are much faster when the graph fits in maintenance_work_mem
+    cursor.execute("SET maintenance_work_mem = '1GB'")
+
+    for name, sql in INDEXES.items():
+        print(f"Building {name}")
+        cursor.execute(sql)
+
+
+# --------------------------- COPY
+def _copy_escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _array_element(value: str) -> str:
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _text_array(values: list[str]) -> str:
+    return '{' + ','.join([_array_element(v) for v in values]) + '}'
+
+
+def _int_array(values: list[int]) -> str:
+    return '{' + ','.join([str(int(v)) for v in values]) + '}'
+
+
+def _int_matrix(values: list[list[int]]) -> str:
+    return '{' + ','.join([_int_array(row) for row in values]) + '}'
+
+
+def _vector(values: list[float]) -> str:
+    return '[' + ','.join([repr(float(v)) for v in values]) + ']'
+
+
+def format_copy_row(video_id: str, frame_id: str, objects: list[str], image_vector: list[float],
+                    dominant_colors: list[list[int]], timestamp: float, text: list[str]) -> str:
+    """
+    Formats one frame as a line of COPY text format, columns in the order of COLUMNS
+    """
+    fields = [
+        video_id + '-' + frame_id,
+        video_id,
+        frame_id,
+        repr(float(timestamp)),
+        _text_array(objects),
+        _int_matrix(dominant_colors),
+        _int_array(pack_colors(dominant_colors)),
+        _int_array(color_bins(dominant_colors)),
+        _vector(image_vector),
+        _text_array(text),
+        ' '.join(text),
+    ]
+
+    return '\t'.join([_copy_escape(f) for f in fields]) + '\n'
 
-        cursor.execute(f"""
-            INSERT INTO frames (id, video_id, frame_id, timestamp, objects, colors, image_vector, text) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        """, (row_id, video_id, frame_id, timestamp, objects, dominant_colors, image_vector, text))
 
+def copy_rows(cursor, rows) -> int:
+    """
+    Streams rows into the frames table with COPY, COPY_BATCH_SIZE rows per statement
+
+    :param cursor: psycopg2 cursor
+    :param rows: iterable of the tuples yielded by get_data
+    :return: number of rows copied
+    """
+    sql = f"COPY frames ({', '.join(COLUMNS)}) FROM STDIN"
+
+    total = 0
+    buffer = io.StringIO()
+    n = 0
+    for row in rows:
+        buffer.write(format_copy_row(*row))
+        n += 1
+
+        if n == COPY_BATCH_SIZE:
+            buffer.seek(0)
+            cursor.copy_expert(sql, buffer)
+            total += n
+            buffer = io.StringIO()
+            n = 0
+
+    if n > 0:
+        buffer.seek(0)
+        cursor.copy_expert(sql, buffer)
+        total += n
+
+    return total
+
+
+# docker compose up
+def add_data_to_pg(video_ids: list[str] = None, collapse_duplicates: bool = False):
+    """
+    Adds the data to the database
+
+    Without video_ids the table is reloaded from scratch: the indexes are dropped, every video is
+    copied in and the indexes are built once at the end.
+    With video_ids only those videos are replaced, each one in its own transaction, and the
+    existing indexes are kept up to date by Postgres.
+
+    :param video_ids: videos to (re)load, defaults to the whole dataset
+    :param collapse_duplicates: skip frames that are near-duplicates of a frame of an earlier video in video_ids
+    """
+    conn = connect_to_db()
+    cursor = conn.cursor()
+
+    create_table(cursor)
+
+    full_load = video_ids is None
+    if full_load:
+        video_ids = get_video_ids()
+        video_ids.append("00182")
+
+        cursor.execute("TRUNCATE frames")
+        drop_indexes(cursor)
+        conn.commit()
+
+    lsh = EmbeddingLSH() if collapse_duplicates else None
+
+    total = 0
+    for video_id in video_ids:
+        # Replacing the rows of a video makes reloading it idempotent
+        cursor.execute("DELETE FROM frames WHERE video_id = %s", (video_id,))
+        total += copy_rows(cursor, get_video_data(video_id, lsh))
+        conn.commit()
+
+    print(f"Loaded {total} frames from {len(video_ids)} videos")
+
+    if full_load:
+        create_indexes(cursor)
+        conn.commit()
+
+    cursor.execute("ANALYZE frames")
     conn.commit()
+
     cursor.close()
     conn.close()
 
 
-def get_data():
+def get_data(collapse_duplicates: bool = False):
     """
-    Loops through all the data.json file in the dataset
-    For each data.json file, it loops through all the frames present in the file,
+    Loops through the feature store of every video in the dataset
 
-    :return: yield's videoId(str), frameId(str), objects(list[str]), imageVector(list[float]), dominantColors(list[list[int]]), timestamp(float), text(list[str])
+    :param collapse_duplicates: skip frames that are near-duplicates of a frame of an earlier video
+    :return: yield's the rows of get_video_data for every video
     """
 
     video_ids = get_video_ids()
     video_ids.append("00182")
 
+    lsh = EmbeddingLSH() if collapse_duplicates else None
+
     for video_id in video_ids:
-        with open(os.path.join(DATA_DIR, video_id, 'data.json'), 'r') as file:
-            data = json.load(file)
+        yield from get_video_data(video_id, lsh)
 
-        prev_image_vector = None
 
-        for frame in data['keyframes']:
-            if len(frame['dominant_colors']) == 1:
+def get_video_data(video_id: str, lsh: EmbeddingLSH = None):
+    """
+    Loops through all the keyframes in the feature store of a video,
+    skipping single color frames and frames too close to the previous one
+
+    :param video_id: name of file in the dataset without the extension
+    :param lsh: when given, frames with a near-duplicate from another video in it are skipped, the others are added
+    :return: yield's videoId(str), frameId(str), objects(list[str]), imageVector(list[float]), dominantColors(list[list[int]]), timestamp(float), text(list[str])
+    """
+    features = load_video_features(video_id)
+
+    rows = [i for i, frame in enumerate(features.keyframes) if frame['num_colors'] != 1]
+    vectors = np.asarray(features.image_vectors[rows], dtype=np.float32)
+    consecutive = l2_consecutive(vectors)
+
+    prev = None
+
+    for j, i in enumerate(rows):
+        if prev is not None:
+            # The previous kept frame is usually the previous frame, its distance is already computed
+            d = consecutive[j - 1] if prev == j - 1 else l2(vectors[prev], vectors[j])
+            if d < 40:
                 continue
 
-            video_id = video_id
-            frame_id = frame['frame_id']
-            objects = sorted(frame['objects'].keys())
-            timestamp = frame['timestamp']
-            image_vector = frame['image_vector']
-            dominant_colors = [v for v in frame['dominant_colors']]
-            text = frame['text']
+        if lsh is not None:
+            duplicate = lsh.query(vectors[j])
+            if duplicate is not None and duplicate[0] != video_id:
+                continue
+            lsh.add((video_id, features.keyframes[i]['frame_id']), vectors[j])
 
-            if prev_image_vector is not None:
-                if l2(prev_image_vector, image_vector) < 40:
-                    continue
+        # Only frames that are yielded are compared to
+        prev = j
 
-            prev_image_vector = image_vector
+        frame = features.keyframes[i]
+        frame_id = frame['frame_id']
+        objects = sorted(frame['objects'].keys())
+        timestamp = frame['timestamp']
+        image_vector = vectors[j].tolist()
+        dominant_colors = features.colors(i)
+        # Feature stores written before the tokens were normalized at ingest are normalized here
+        text = normalize_tokens(frame['text'])
 
-            yield video_id, frame_id, objects, image_vector, dominant_colors, timestamp, text
+        yield video_id, frame_id, objects, image_vector, dominant_colors, timestamp, text
 
 
 if __name__ == '__main__':
-    add_data_to_pg()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--videos', nargs='+', default=None, help='only replace these videos, defaults to a full reload')
+    parser.add_argument('--collapse-duplicates', action='store_true',
+                        help='skip frames that are near-duplicates of frames of other videos (re-uploaded footage)')
+    args = parser.parse_args()
+
+    add_data_to_pg(args.videos, args.collapse_duplicates)
@@ -0,0 +1,154 @@
+"""
+Lightweight timing instrumentation
+
+timer(phase) records the wall time of a block into the latency histogram phase_seconds{phase=...} of this
+process and, inside collect(), into the phase totals of the current thread. The server exposes the histograms
+in the Prometheus text format on /metrics and the totals of a request in its Server-Timing header,
+ingest.py stores the totals of every stage in the manifest.
+"""
+import time
+import threading
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+
+# Upper bounds in seconds, from sub-millisecond SQL to minutes long ffmpeg runs
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Histogram:
+    """
+    Thread safe histogram with fixed buckets
+    """
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+_local = threading.local()
+
+
+def observe(name: str, value: float, **labels):
+    key = (name, tuple(sorted(labels.items())))
+
+    with _histograms_lock:
+        if key not in _histograms:
+            _histograms[key] = Histogram()
+
+    _histograms[key].observe(value)
+
+
+@contextmanager
+def collect():
+    """
+    Collects the time of the phases timed in the block on the current thread
+
+    :return: dict phase -> seconds, filled in when the block exits
+    """
+    previous = getattr(_local, 'phases', None)
+    _local.phases = {}
+
+    try:
+        yield _local.phases
+    finally:
+        _local.phases = previous
+
+
+def start_collecting():
+    _local.phases = {}
+
+
+def stop_collecting() -> dict:
+    phases = getattr(_local, 'phases', None) or {}
+    _local.phases = None
+    return phases
+
+
+def record(phase: str, seconds: float, name: str = 'phase_seconds'):
+    observe(name, seconds, phase=phase)
+
+    phases = getattr(_local, 'phases', None)
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0) + seconds
+
+
+@contextmanager
+def timer(phase: str, name: str = 'phase_seconds'):
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - start, name)
+
+
+def timed_iter(iterable: Iterable, phase: str) -> Iterator:
+    """
+    Yields the items of iterable, timing how long producing each one takes (e.g. decoding a frame)
+    """
+    iterator = iter(iterable)
+
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+
+        record(phase, time.perf_counter() - start)
+        yield item
+
+
+def _format_labels(labels: tuple) -> str:
+    return ','.join([f'{k}="{v}"' for k, v in labels])
+
+
+def render() -> str:
+    """
+    :return: all histograms in the Prometheus text exposition format
+    """
+    with _histograms_lock:
+        histograms = sorted(_histograms.items())
+
+    lines = []
+    previous = None
+    for (name, labels), h in histograms:
+        if name != previous:
+            lines.append(f'# TYPE {name} histogram')
+            previous = name
+
+        with h._lock:
+            counts, total, count = list(h.counts), h.sum, h.count
+
+        label_prefix = _format_labels(labels) + ',' if labels else ''
+        cumulative = 0
+        for bound, c in zip(list(h.buckets) + ['+Inf'], counts):
+            cumulative += c
+            lines.append(f'{name}_bucket{{{label_prefix}le="{bound}"}} {cumulative}')
+
+        lines.append(f'{name}_sum{{{_format_labels(labels)}}} {total}')
+        lines.append(f'{name}_count{{{_format_labels(labels)}}} {count}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def server_timing(phases: dict) -> str:
+    """
+    :return: value of a Server-Timing header, durations in milliseconds
+    """
+    return ', '.join([f'{phase};dur={seconds * 1000:.1f}' for phase, seconds in phases.items()])
@@ -0,0 +1,163 @@
+"""
+Lazily loaded models
+
+torch, clip, easyocr and ultralytics are imported by the loaders, so importing this module (and utils)
+is cheap and a process only pays for the models it actually uses. The search server only needs one
+CLIP tower per query type: 'clip_text' and 'clip_image' keep the text or the image half of CLIP and
+free the other one. A process that needs both loads the checkpoint once per tower, unless it loads
+the full model with get_clip() first.
+
+CLIP_BACKEND        'fp32' (default), 'int8' (dynamic int8 quantization of the linear layers) or
+                    'torchscript' (traced towers), see benchmarks/clip_backends.py for their speed and accuracy
+CLIP_NUM_THREADS    torch intra-op threads of the encoders, the torch default when unset
+"""
+import os
+import threading
+
+
+# CONSTANTS
+CLIP_MODEL_NAME = "ViT-L/14"
+YOLO_MODEL_NAME = "yolov8x.pt"
+OCR_LANGUAGES = ['en']
+
+CLIP_BACKENDS = ['fp32', 'int8', 'torchscript']
+CLIP_BACKEND = os.environ.get('CLIP_BACKEND', 'fp32')
+CLIP_NUM_THREADS = int(os.environ.get('CLIP_NUM_THREADS', 0))
+
+# Submodules of CLIP that only the text tower uses
+CLIP_TEXT_MODULES = ['transformer', 'token_embedding', 'ln_final']
+
+
+_models = {}
+_lock = threading.Lock()
+
+
+# FUNCTIONS
+def _load_clip():
+    import torch
+    import clip
+
+    if CLIP_BACKEND not in CLIP_BACKENDS:
+        raise Exception(f"Unknown CLIP backend {CLIP_BACKEND}")
+
+    if CLIP_NUM_THREADS > 0:
+        torch.set_num_threads(CLIP_NUM_THREADS)
+
+    model, preprocess = clip.load(CLIP_MODEL_NAME)
+    model.eval()
+
+    if CLIP_BACKEND == 'int8':
+        # Weights of the linear layers (most of the FLOPs of both transformers) in int8,
+        # activations are quantized on the fly
+        torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    return model, preprocess
+
+
+def _load_clip_text():
+    import torch
+    import clip
+    from clip.model import CLIP
+
+    model, _ = _models['clip'] if 'clip' in _models else _load_clip()
+
+    class TextTower(torch.nn.Module):
+        # CLIP.encode_text only uses the text submodules and the dtype of the model
+        encode_text = CLIP.encode_text
+
+        def __init__(self):
+            super().__init__()
+            for name in CLIP_TEXT_MODULES:
+                setattr(self, name, getattr(model, name))
+            self.positional_embedding = model.positional_embedding
+            self.text_projection = model.text_projection
+            self.dtype = model.dtype
+
+    tower = TextTower().eval()
+
+    if CLIP_BACKEND == 'torchscript':
+        with torch.no_grad():
+            tower = torch.jit.trace_module(tower, {'encode_text': clip.tokenize(['a photo of a person'])})
+
+    return tower
+
+
+def _load_clip_image():
+    import torch
+
+    model, preprocess = _models['clip'] if 'clip' in _models else _load_clip()
+
+    if 'clip' not in _models:
+        # encode_image only runs model.visual, the rest of a private copy can go
+        for name in CLIP_TEXT_MODULES:
+            delattr(model, name)
+
+    if CLIP_BACKEND == 'torchscript' and not isinstance(model.visual, torch.jit.ScriptModule):
+        size = model.visual.input_resolution
+        with torch.no_grad():
+            model.visual = torch.jit.trace(model.visual, torch.zeros(1, 3, size, size, dtype=model.dtype))
+
+    return model, preprocess
+
+
+def _load_yolo():
+    from ultralytics import YOLO
+
+    return YOLO(YOLO_MODEL_NAME)
+
+
+def _load_ocr():
+    import easyocr
+
+    return easyocr.Reader(OCR_LANGUAGES, quantize=False)
+
+
+_loaders = {
+    'clip': _load_clip,
+    'clip_text': _load_clip_text,
+    'clip_image': _load_clip_image,
+    'yolo': _load_yolo,
+    'ocr': _load_ocr,
+}
+
+
+def get_model(name: str):
+    """
+    Returns the model registered under name, loading it on first use.
+    Each model is constructed at most once per process.
+
+    :param name: one of 'clip', 'clip_text', 'clip_image', 'yolo', 'ocr'
+    :return: the loaded model ('clip' and 'clip_image' return a (model, preprocess) tuple)
+    """
+    if name not in _loaders:
+        raise Exception(f"Unknown model {name}")
+
+    with _lock:
+        if name not in _models:
+            _models[name] = _loaders[name]()
+
+    return _models[name]
+
+
+def loaded_models() -> list[str]:
+    return list(_models)
+
+
+def get_clip():
+    return get_model('clip')
+
+
+def get_clip_text():
+    return get_model('clip_text')
+
+
+def get_clip_image():
+    return get_model('clip_image')
+
+
+def get_yolo():
+    return get_model('yolo')
+
+
+def get_ocr():
+    return get_model('ocr')
@@ -0,0 +1,121 @@
+"""
+Cheap near-duplicate detection
+
+Within a video, keyframes are compared with a 64 bit difference hash of a tiny grayscale thumbnail
+before any model runs on them. Blank (near uniform) frames are dropped the same way.
+Across videos, EmbeddingLSH finds re-uploaded footage from the CLIP embeddings with random hyperplane LSH.
+"""
+import cv2 as cv
+import numpy as np
+from numpy.typing import ArrayLike
+
+from distance import cosine_one_to_many
+
+# Frames whose hashes differ in at most this many of the 64 bits are duplicates
+DEDUP_MAX_HAMMING = 4
+# Frames whose low resolution grayscale has a smaller standard deviation are blank
+BLANK_MAX_STD = 4.0
+
+# Cosine distance under which frames of different videos are duplicates
+CROSS_VIDEO_MAX_DISTANCE = 0.05
+
+
+def _thumbnail(frame: np.ndarray, width: int, height: int) -> np.ndarray:
+    gray = cv.cvtColor(frame, cv.COLOR_RGB2GRAY)
+    return cv.resize(gray, (width, height), interpolation=cv.INTER_AREA)
+
+
+def difference_hash(frame: np.ndarray, hash_size: int = 8) -> int:
+    """
+    :param frame: RGB frame
+    :return: hash_size * hash_size bit hash, set where a pixel is brighter than its right neighbour
+    """
+    small = _thumbnail(frame, hash_size + 1, hash_size).astype(np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def is_blank(frame: np.ndarray, max_std: float = BLANK_MAX_STD) -> bool:
+    return float(_thumbnail(frame, 32, 32).std()) < max_std
+
+
+class FrameDeduplicator:
+    """
+    Drops blank frames and frames too similar to the last kept one
+    """
+
+    def __init__(self, max_hamming: int = DEDUP_MAX_HAMMING, max_std: float = BLANK_MAX_STD):
+        self.max_hamming = max_hamming
+        self.max_std = max_std
+        self.last_hash = None
+        self.skipped = 0
+
+    def keep(self, frame: np.ndarray) -> bool:
+        if is_blank(frame, self.max_std):
+            self.skipped += 1
+            return False
+
+        h = difference_hash(frame)
+        if self.last_hash is not None and hamming(h, self.last_hash) <= self.max_hamming:
+            self.skipped += 1
+            return False
+
+        self.last_hash = h
+        return True
+
+
+class EmbeddingLSH:
+    """
+    Random hyperplane LSH over embeddings, candidates found in any table are verified with the cosine distance
+    """
+
+    def __init__(self, dim: int = 768, num_bits: int = 16, num_tables: int = 8,
+                 max_distance: float = CROSS_VIDEO_MAX_DISTANCE, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.planes = rng.standard_normal((num_tables, num_bits, dim)).astype(np.float32)
+        self.powers = (1 << np.arange(num_bits)).astype(np.int64)
+        self.tables = [{} for _ in range(num_tables)]
+        self.max_distance = max_distance
+        self.keys = []
+        self.vectors = []
+
+    def _normalize(self, vec: ArrayLike) -> np.ndarray:
+        vec = np.asarray(vec, dtype=np.float32)
+        return vec / max(float(np.linalg.norm(vec)), 1e-12)
+
+    def _buckets(self, vec: np.ndarray) -> np.ndarray:
+        return ((self.planes @ vec) > 0).astype(np.int64) @ self.powers
+
+    def query(self, vec: ArrayLike):
+        """
+        :return: key of the closest stored embedding within max_distance, or None
+        """
+        vec = self._normalize(vec)
+
+        candidates = set()
+        for table, bucket in zip(self.tables, self._buckets(vec)):
+            candidates.update(table.get(int(bucket), []))
+
+        if not candidates:
+            return None
+
+        candidates = list(candidates)
+        distances = cosine_one_to_many(vec, np.array([self.vectors[i] for i in candidates]), normalized=True)
+        best = int(np.argmin(distances))
+
+        return self.keys[candidates[best]] if distances[best] < self.max_distance else None
+
+    def add(self, key, vec: ArrayLike):
+        vec = self._normalize(vec)
+
+        i = len(self.keys)
+        self.keys.append(key)
+        self.vectors.append(vec)
+
+        for table, bucket in zip(self.tables, self._buckets(vec)):
+            table.setdefault(int(bucket), []).append(i)
@@ -1,8 +1,149 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extensions import connection as _connection
+
+DB_PARAMS = {
+    'database': "vectordb",
+    'host': "127.0.0.1",
+    'user': "admin",
+    'password': "admin",
+    'port': "5432"
+}
+
+POOL_MIN_CONN = 1
+POOL_MAX_CONN = int(os.environ.get('DB_POOL_SIZE', 16))
+# Seconds a request waits for a free connection before it is answered with 503
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+
+# Connections idle for longer than this are checked with a round trip before being handed out
+HEALTH_CHECK_INTERVAL = 30
+
+_pool = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises PoolError as soon as all its connections are in use, checkouts wait on this instead
+_pool_slots = threading.BoundedSemaphore(POOL_MAX_CONN)
+
+
+class PooledConnection(_connection):
+    """
+    Connection that remembers its prepared statements and when it was last used
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.last_used = time.monotonic()
 
 
 def connect_to_db():
-    return psycopg2.connect(database="vectordb", host="127.0.0.1", user="admin", password="admin", port="5432")
+    return psycopg2.connect(**DB_PARAMS)
+
+
+def get_pool() -> ThreadedConnectionPool:
+    """
+    Returns the connection pool of this process, created on first use so that
+    every worker of a pre-forking server gets its own
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadedConnectionPool(POOL_MIN_CONN, POOL_MAX_CONN, connection_factory=PooledConnection,
+                                           **DB_PARAMS)
+
+    return _pool
+
+
+def _is_healthy(conn: PooledConnection) -> bool:
+    if conn.closed:
+        return False
+
+    if time.monotonic() - conn.last_used < HEALTH_CHECK_INTERVAL:
+        return True
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _checkout() -> PooledConnection:
+    pool = get_pool()
+
+    # A dropped connection is replaced by a new one, at most POOL_MAX_CONN times
+    for _ in range(POOL_MAX_CONN + 1):
+        conn = pool.getconn()
+        if _is_healthy(conn):
+            return conn
+
+        pool.putconn(conn, close=True)
+
+    raise psycopg2.OperationalError("Unable to get a healthy database connection")
+
+
+@contextmanager
+def db_cursor(name: str = None):
+    """
+    Checks a connection out of the pool and yields a cursor on it.
+    The transaction is committed when the block exits and rolled back on error,
+    a connection that failed is closed instead of being returned to the pool
+
+    :param name: open a server-side cursor with this name, rows are then fetched in batches of cursor.itersize
+    """
+    if not _pool_slots.acquire(timeout=POOL_TIMEOUT):
+        raise psycopg2.OperationalError(f"No free database connection after {POOL_TIMEOUT}s")
+
+    try:
+        conn = _checkout()
+    except Exception:
+        _pool_slots.release()
+        raise
+
+    try:
+        with conn.cursor(name=name) as cursor:
+            yield cursor
+        conn.commit()
+
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        get_pool().putconn(conn, close=True)
+        conn = None
+        raise
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        if conn is not None:
+            conn.last_used = time.monotonic()
+            get_pool().putconn(conn)
+        _pool_slots.release()
+
+
+def execute_prepared(cursor, name: str, sql: str, params: tuple):
+    """
+    Executes sql as a server-side prepared statement, preparing it once per connection
+
+    :param cursor: cursor of a connection from the pool
+    :param name: statement name
+    :param sql: statement using $1, $2, ... placeholders
+    :param params: parameter values
+    """
+    conn = cursor.connection
+    if name not in conn.prepared:
+        cursor.execute(f"PREPARE {name} AS {sql}")
+        conn.prepared.add(name)
+
+    placeholders = ', '.join(['%s'] * len(params))
+    cursor.execute(f"EXECUTE {name} ({placeholders})" if params else f"EXECUTE {name}", params)
 
 
 if __name__ == "__main__":
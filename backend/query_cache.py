@@ -0,0 +1,205 @@
+"""
+Bounded LRU cache of query embeddings
+
+Text queries are keyed on their normalized text, image queries on the SHA-256 of the uploaded image,
+so a hit skips the image decode as well as the CLIP forward pass.
+
+QUERY_CACHE_SIZE    maximum number of cached embeddings (default 4096)
+QUERY_CACHE_FILE    .npz file the cache is loaded from at startup and saved to at exit
+QUERY_LOG_FILE      text queries are appended to this file, the most frequent ones are encoded in the background
+                    after startup
+
+Misses are encoded in-process or by the embedding worker, see embedding_worker.py
+"""
+import os
+import re
+import atexit
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict, Counter
+from typing import Callable, List
+
+from embedding_worker import encode_texts, encode_image_bytes
+
+QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', 4096))
+QUERY_CACHE_FILE = os.environ.get('QUERY_CACHE_FILE')
+QUERY_LOG_FILE = os.environ.get('QUERY_LOG_FILE')
+
+# Number of distinct queries from the log encoded at startup
+WARM_UP_QUERIES = 512
+
+
+class LRUCache:
+    """
+    Thread safe least recently used cache with hit / miss / eviction counters
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def items(self):
+        with self._lock:
+            return list(self._data.items())
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0
+        }
+
+
+cache = LRUCache(QUERY_CACHE_SIZE)
+_log_lock = threading.Lock()
+
+
+def normalize_text(text: str) -> str:
+    # CLIP's tokenizer lower cases and collapses whitespace too, so this does not change the embedding
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+
+def _cached(key: str, encode: Callable[[], List[float]]) -> List[float]:
+    vec = cache.get(key)
+    if vec is None:
+        vec = encode()
+        cache.put(key, vec)
+
+    return vec
+
+
+def encode_text_cached(text: str) -> List[float]:
+    text = normalize_text(text)
+    log_query(text)
+
+    return _cached('text:' + text, lambda: encode_texts([text])[0])
+
+
+def encode_texts_cached(texts: List[str]) -> List[List[float]]:
+    """
+    Encodes the texts missing from the cache with a single forward pass
+
+    :return: vectors in the order of texts
+    """
+    texts = [normalize_text(text) for text in texts]
+    for text in texts:
+        log_query(text)
+
+    vectors = {text: cache.get('text:' + text) for text in set(texts)}
+    missing = [text for text, vec in vectors.items() if vec is None]
+
+    if missing:
+        for text, vec in zip(missing, encode_texts(missing)):
+            cache.put('text:' + text, vec)
+            vectors[text] = vec
+
+    return [vectors[text] for text in texts]
+
+
+def encode_image_cached(image_bytes: bytes, decode: Callable[[bytes], object]) -> List[float]:
+    """
+    :param image_bytes: raw bytes of the uploaded image
+    :param decode: turns the bytes into a PIL image, only called on a miss
+    """
+    key = 'image:' + hashlib.sha256(image_bytes).hexdigest()
+
+    return _cached(key, lambda: encode_image_bytes(image_bytes, decode))
+
+
+def log_query(text: str):
+    if not QUERY_LOG_FILE:
+        return
+
+    with _log_lock:
+        with open(QUERY_LOG_FILE, 'a') as f:
+            f.write(text.replace('\n', ' ') + '\n')
+
+
+def save(path: str):
+    items = cache.items()
+    if len(items) == 0:
+        return
+
+    keys = np.array([k for k, _ in items])
+    vectors = np.array([v for _, v in items], dtype=np.float32)
+    # Every worker process saves at exit, written to a file of its own and renamed so a reader never sees a
+    # partial file. Written through a file object so numpy does not append .npz to the path
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, keys=keys, vectors=vectors)
+    os.replace(tmp, path)
+
+
+def load(path: str):
+    if not os.path.exists(path):
+        return
+
+    data = np.load(path)
+    for key, vec in zip(data['keys'].tolist(), data['vectors'].tolist()):
+        cache.put(key, vec)
+
+
+def warm_up(query_log_file: str, n: int = WARM_UP_QUERIES, batch_size: int = 32):
+    """
+    Encodes the n most frequent queries of the log that are not cached yet
+    """
+    if not os.path.exists(query_log_file):
+        return
+
+    with open(query_log_file, 'r') as f:
+        counts = Counter([normalize_text(l) for l in f if l.strip()])
+
+    texts = [t for t, _ in counts.most_common(n) if 'text:' + t not in cache]
+
+    for i in range(0, len(texts), batch_size):
+        batch = texts[i:i + batch_size]
+        for text, vec in zip(batch, encode_texts(batch)):
+            cache.put('text:' + text, vec)
+
+
+def init():
+    """
+    Loads the persisted cache and starts warming it up from the query log, called once at server startup.
+    The warm-up runs in a background thread, so the model is loaded and the queries encoded while requests
+    are already served
+    """
+    if QUERY_CACHE_FILE:
+        load(QUERY_CACHE_FILE)
+        atexit.register(save, QUERY_CACHE_FILE)
+
+    if QUERY_LOG_FILE:
+        threading.Thread(target=warm_up, args=(QUERY_LOG_FILE,), name='query-cache-warm-up', daemon=True).start()
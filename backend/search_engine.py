@@ -0,0 +1,589 @@
+"""
+Search over the frames table, or over the in-process vector_index with SEARCH_BACKEND=memory
+
+Vector queries are answered in two stages: an ANN friendly top-k candidate query per query vector
+(ORDER BY image_vector <=> q LIMIT k, which the HNSW index serves) with the object, color and word filters
+applied, followed by the similarity thresholds and a rerank of the candidates on the combined
+text + image + color score. Only the columns of the response are fetched.
+"""
+import os
+import re
+import json
+import base64
+import threading
+import numpy as np
+from dataclasses import dataclass
+from typing import Iterator, List, Optional
+
+from postgres_db import db_cursor, execute_prepared
+from metrics import timer
+from text_index import WORD_MATCHES, FUZZY_MIN_SIMILARITY, normalize_tokens, token_similarities, word_distance, \
+    trigram_threshold
+from utils_server import get_neighbour_color_bins, color_distances, unpack_colors
+from vector_index import VectorIndex
+
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'postgres')
+
+# Candidates fetched per query vector, relative to maxResults, so the color score can still reorder them
+CANDIDATE_FACTOR = 4
+MIN_CANDIDATES = 100
+
+# Upper bound of hnsw.ef_search, pgvector ignores larger values
+MAX_EF_SEARCH = 1000
+
+# objectsContain values and wordMatch values (text_index.WORD_MATCHES) -> their part of the prepared statement names,
+# names are built only from these fixed tokens, never from request values
+OBJECTS_CONTAIN = {'any': 'any', 'all': 'all', 'only': 'only'}
+WORD_MATCH_NAMES = {'exact': 'e', 'prefix': 'p', 'fuzzy': 'f'}
+
+# Rows fetched per round trip by the server-side cursors of the streaming responses
+STREAM_ITERSIZE = 100
+
+
+class InvalidQuery(Exception):
+    """
+    A search or explore request the client has to fix, answered with 400
+    """
+
+
+@dataclass
+class SearchQuery:
+    text_vec: Optional[List[float]]
+    image_vec: Optional[List[float]]
+    objects: List[str]
+    objects_contain: str
+    color: Optional[List[int]]
+    color_radius: int
+    words: List[str]
+    word_match: str
+    max_text_distance: float
+    max_image_distance: float
+    max_results: int
+
+    @staticmethod
+    def from_request(data: dict, text_vec: Optional[List[float]], image_vec: Optional[List[float]]):
+        """
+        :param data: body of a /search request
+        :param text_vec: encoded textQuery or None
+        :param image_vec: encoded imageQuery or None
+        """
+        query = data['query']
+        params = data['searchParams']
+
+        word_match = params.get('wordMatch', 'exact')
+        if word_match not in WORD_MATCHES:
+            raise InvalidQuery(f"wordMatch must be one of {', '.join(WORD_MATCHES)}")
+
+        objects_contain = params['objectsContain']
+        if objects_contain not in OBJECTS_CONTAIN:
+            raise InvalidQuery(f"objectsContain must be one of {', '.join(OBJECTS_CONTAIN)}")
+
+        return SearchQuery(
+            text_vec=text_vec,
+            image_vec=image_vec,
+            objects=query['objectQuery'] or [],
+            objects_contain=objects_contain,
+            color=[int(c) for c in query['colorQuery']] if query['colorQuery'] else None,
+            color_radius=int(params['colorRadius']),
+            words=normalize_tokens(query['wordQuery'] or []),
+            word_match=word_match,
+            max_text_distance=float(params['maxTextSimilarity']),
+            max_image_distance=float(params['maxImageSimilarity']),
+            max_results=int(params['maxResults'])
+        )
+
+    def num_candidates(self) -> int:
+        return max(self.max_results * CANDIDATE_FACTOR, MIN_CANDIDATES)
+
+
+class _Params:
+    """
+    Collects statement parameters and hands out their $n placeholders
+    """
+
+    def __init__(self):
+        self.values = []
+
+    def add(self, value, cast: str) -> str:
+        self.values.append(value)
+        return f'${len(self.values)}::{cast}'
+
+
+def vector_literal(vec: List[float]) -> str:
+    return '[' + ','.join([repr(float(v)) for v in vec]) + ']'
+
+
+def _filters(query: SearchQuery, params: _Params) -> List[str]:
+    filters = []
+
+    if query.objects:
+        if query.objects_contain == 'any':
+            filters.append(f"objects && {params.add(query.objects, 'text[]')}")
+        elif query.objects_contain == 'all':
+            filters.append(f"objects @> {params.add(query.objects, 'text[]')}")
+        elif query.objects_contain == 'only':
+            filters.append(f"objects = {params.add(sorted(query.objects), 'text[]')}")
+
+    if query.color:
+        r, g, b = query.color
+        bins = params.add(get_neighbour_color_bins(query.color, query.color_radius), 'int[]')
+        pr, pg, pb = params.add(r, 'int'), params.add(g, 'int'), params.add(b, 'int')
+        n = params.add(query.color_radius, 'int')
+        # Indexed lookup of the bins around the color, then the exact per-channel radius check
+        filters.append(f"""color_bins && {bins} AND EXISTS (
+            SELECT 1 FROM unnest(color_codes) c
+            WHERE abs((c >> 16) - {pr}) <= {n} AND abs(((c >> 8) & 255) - {pg}) <= {n} AND abs((c & 255) - {pb}) <= {n}
+        )""")
+
+    if query.words:
+        if query.word_match == 'exact':
+            filters.append(f"text && {params.add(query.words, 'text[]')}")
+        elif query.word_match == 'prefix':
+            # A token of text_doc starting with one of the words, served by the trigram index
+            filters.append(f"text_doc ~ {params.add('(^| )(' + '|'.join(query.words) + ')', 'text')}")
+        elif query.word_match == 'fuzzy':
+            # text_doc shares a trigram with one of the words (pg_trgm.word_similarity_threshold is lowered to
+            # trigram_threshold, see _set_search_settings), served by the trigram index, then the edit distance check
+            words = params.add(query.words, 'text[]')
+            filters.append(f"""text_doc %> ANY({words}) AND EXISTS (
+                SELECT 1 FROM unnest({words}) w CROSS JOIN unnest(text) t
+                WHERE 1 - levenshtein(w, t)::float8 / greatest(length(w), length(t)) >= {params.add(FUZZY_MIN_SIMILARITY, 'float8')}
+            )""")
+
+    return filters
+
+
+def _word_distance_sql(query: SearchQuery, params: _Params, text: str) -> str:
+    """
+    text_index.word_distance in SQL
+
+    :param text: the text[] column of the frame
+    """
+    word, token = 'w', 't'
+    if query.word_match == 'exact':
+        similarity = f'({token} = {word})::int'
+    elif query.word_match == 'prefix':
+        similarity = f'CASE WHEN starts_with({token}, {word}) THEN length({word})::float8 / length({token}) ELSE 0 END'
+    else:
+        edits = f'1 - levenshtein({word}, {token})::float8 / greatest(length({word}), length({token}))'
+        similarity = f"CASE WHEN {edits} >= {params.add(FUZZY_MIN_SIMILARITY, 'float8')} THEN {edits} ELSE 0 END"
+
+    words = params.add(query.words, 'text[]')
+    return f"""(1 - (SELECT coalesce(sum(best), 0) FROM (
+                SELECT max({similarity}) AS best FROM unnest({words}) {word} CROSS JOIN unnest({text}) {token} GROUP BY {word}
+            ) m)::float8 / cardinality({words}))"""
+
+
+def _statement_name(query: SearchQuery) -> str:
+    # One prepared statement per combination of query parts
+    return 'search_' + ''.join([
+        't' if query.text_vec is not None else '',
+        'i' if query.image_vec is not None else '',
+        'o' + OBJECTS_CONTAIN[query.objects_contain] if query.objects else '',
+        'c' if query.color else '',
+        'w' + WORD_MATCH_NAMES[query.word_match] if query.words else '',
+    ])
+
+
+def build_search_sql(query: SearchQuery):
+    """
+    :return: statement name, sql with $n placeholders, parameter values
+    """
+    params = _Params()
+    filters = _filters(query, params)
+    k = params.add(query.num_candidates(), 'int')
+
+    where = ('WHERE ' + ' AND '.join(filters)) if filters else ''
+    columns = 'f.video_id, f.frame_id, f.timestamp, f.color_codes, f.objects, f.text'
+
+    vectors = [('text_distance', query.text_vec, query.max_text_distance),
+               ('image_distance', query.image_vec, query.max_image_distance)]
+    vectors = [(name, params.add(vector_literal(vec), 'vector'), max_distance) for name, vec, max_distance in vectors
+               if vec is not None]
+
+    if not vectors:
+        # Without query vectors the word and color scores are the only ranking, computed in the database
+        order = []
+        if query.words:
+            order.append(_word_distance_sql(query, params, 'f.text'))
+        if query.color:
+            r, g, b = query.color
+            order.append(f"""(SELECT min(((c >> 16) - {params.add(r, 'int')}) ^ 2 + (((c >> 8) & 255) - {params.add(g, 'int')}) ^ 2
+                            + ((c & 255) - {params.add(b, 'int')}) ^ 2) FROM unnest(f.color_codes) c)""")
+        order = ', '.join(order) or 'f.video_id, f.timestamp'
+
+        sql = f"""
+            SELECT {columns}, NULL::float8 AS text_distance, NULL::float8 AS image_distance FROM frames f
+            {where}
+            ORDER BY {order}
+            LIMIT {k}
+        """
+        return _statement_name(query), sql, params.values
+
+    candidates = ' UNION '.join([f"""(
+            SELECT id FROM frames {where}
+            ORDER BY image_vector <=> {vec}
+            LIMIT {k}
+        )""" for _, vec, _ in vectors])
+
+    distances = {name: f'f.image_vector <=> {vec}' for name, vec, _ in vectors}
+    thresholds = ' OR '.join([f"d.{name} < {params.add(max_distance, 'float8')}" for name, _, max_distance in vectors])
+
+    sql = f"""
+        SELECT {columns}, d.text_distance, d.image_distance
+        FROM ({candidates}) candidates
+        JOIN frames f ON f.id = candidates.id
+        CROSS JOIN LATERAL (
+            SELECT {distances.get('text_distance', 'NULL::float8')} AS text_distance,
+                   {distances.get('image_distance', 'NULL::float8')} AS image_distance
+        ) d
+        WHERE {thresholds}
+    """
+    return _statement_name(query), sql, params.values
+
+
+def build_ranked_sql(query: SearchQuery, after: Optional[list] = None, page_size: Optional[int] = None):
+    """
+    build_search_sql with the score of rerank computed in the database and the results ordered by
+    (score, video_id, frame_id), so they can be paged by keyset and streamed
+
+    :param after: search_key of the last row of the previous page or None
+    :param page_size: number of rows returned or None for all max_results
+    :return: statement name, sql with $n placeholders, parameter values
+    """
+    name, sql, values = build_search_sql(query)
+    params = _Params()
+    params.values = list(values)
+
+    score = 'coalesce(r.text_distance, 0) + coalesce(r.image_distance, 0)'
+    if query.color:
+        r, g, b = query.color
+        score += f""" + (SELECT min(((c >> 16) - {params.add(r, 'int')}) ^ 2 + (((c >> 8) & 255) - {params.add(g, 'int')}) ^ 2
+                       + ((c & 255) - {params.add(b, 'int')}) ^ 2) FROM unnest(r.color_codes) c) / 255"""
+    if query.words:
+        score += ' + ' + _word_distance_sql(query, params, 'r.text')
+
+    max_results = params.add(query.max_results, 'int')
+    after_score, after_video, after_frame = after or (None, None, None)
+    after_score = params.add(after_score, 'float8')
+    after_video, after_frame = params.add(after_video, 'text'), params.add(after_frame, 'text')
+    limit = params.add(page_size, 'int')
+
+    # The keyset is compared in byte order, the order of Python strings
+    sql = f"""
+        SELECT * FROM (
+            SELECT r.*, {score} AS score FROM ({sql}) r
+            ORDER BY score, r.video_id COLLATE "C", r.frame_id COLLATE "C"
+            LIMIT {max_results}
+        ) s
+        WHERE {after_score} IS NULL
+           OR (s.score, s.video_id COLLATE "C", s.frame_id COLLATE "C") > ({after_score}, {after_video}, {after_frame})
+        ORDER BY s.score, s.video_id COLLATE "C", s.frame_id COLLATE "C"
+        LIMIT {limit}
+    """
+    return name + '_ranked', sql, params.values
+
+
+def build_batch_sql(queries: List[SearchQuery]):
+    """
+    The statements of build_search_sql for every query as branches of one UNION ALL, so a batch is a single
+    round trip. Each branch keeps its own ANN ordered candidate scan, the queries of a batch may have different
+    filters. Rows start with the index of their query
+
+    :return: sql with $n placeholders, parameter values
+    """
+    branches = []
+    values = []
+    for i, query in enumerate(queries):
+        _, sql, params = build_search_sql(query)
+        # Renumber the placeholders of the branch after those of the previous branches
+        offset = len(values)
+        sql = re.sub(r'\$(\d+)', lambda m: f'${int(m.group(1)) + offset}', sql)
+        branches.append(f"(SELECT {i} AS query_index, b.* FROM ({sql}) b)")
+        values += params
+
+    return '\nUNION ALL\n'.join(branches), values
+
+
+def to_pyformat(sql: str, values: list):
+    """
+    Rewrites $n placeholders for cursor.execute, server-side cursors cannot EXECUTE a prepared statement
+
+    :return: sql with %(pn)s placeholders, parameter dict
+    """
+    sql = re.sub(r'\$(\d+)', r'%(p\1)s', sql.replace('%', '%%'))
+    return sql, {f'p{i + 1}': v for i, v in enumerate(values)}
+
+
+def rerank(rows: list, query: SearchQuery) -> List[dict]:
+    """
+    Scores the candidates with the combined distance and keeps the best max_results
+
+    :param rows: (video_id, frame_id, timestamp, color_codes, objects, text, text_distance, image_distance)
+    :param query: the search query
+    :return: response dicts sorted by score
+    """
+    scores = np.array([(row[6] or 0) + (row[7] or 0) for row in rows], dtype=np.float64)
+
+    if query.color and rows:
+        scores += color_distances([row[3] or [] for row in rows], query.color) / 255
+
+    if query.words:
+        similarities = token_similarities(query.words, {t for row in rows for t in row[5] or []}, query.word_match)
+        scores += np.array([word_distance(similarities, row[5] or []) for row in rows])
+
+    order = np.argsort(scores, kind='stable')[:query.max_results]
+
+    return [{
+        'video_id': rows[i][0],
+        'frame_id': rows[i][1],
+        'timestamp': rows[i][2],
+        'dominant_colors': unpack_colors(rows[i][3] or []),
+        'objects': rows[i][4],
+        'text': rows[i][5],
+        'score': float(scores[i])
+    } for i in order]
+
+
+def _ranked_result(row) -> dict:
+    video_id, frame_id, timestamp, color_codes, objects, text, _, _, score = row
+    return {
+        'video_id': video_id,
+        'frame_id': frame_id,
+        'timestamp': timestamp,
+        'dominant_colors': unpack_colors(color_codes or []),
+        'objects': objects,
+        'text': text,
+        'score': float(score)
+    }
+
+
+def _explore_result(row) -> dict:
+    video_id, frame_id, timestamp, colors, objects, text = row
+    return {
+        'video_id': video_id,
+        'frame_id': frame_id,
+        'timestamp': timestamp,
+        'dominant_colors': colors,
+        'objects': objects,
+        'text': text,
+        'score': 0
+    }
+
+
+EXPLORE_SQL = """
+    SELECT video_id, frame_id, timestamp, colors, objects, text FROM frames
+    WHERE video_id = $1::text
+      AND ($2::float8 IS NULL OR (timestamp, frame_id COLLATE "C") > ($2::float8, $3::text))
+    ORDER BY timestamp ASC, frame_id COLLATE "C"
+    LIMIT $4::int
+"""
+
+
+class PostgresBackend:
+
+    def _set_search_settings(self, cursor, queries: List[SearchQuery]):
+        # The HNSW scan has to produce enough rows to survive the filters
+        cursor.execute("SET LOCAL hnsw.ef_search = %s",
+                       (min(max([q.num_candidates() for q in queries]), MAX_EF_SEARCH),))
+
+        fuzzy = [w for q in queries if q.word_match == 'fuzzy' for w in q.words]
+        if fuzzy:
+            cursor.execute("SET LOCAL pg_trgm.word_similarity_threshold = %s", (trigram_threshold(fuzzy),))
+
+    def search(self, query: SearchQuery) -> List[dict]:
+        name, sql, params = build_search_sql(query)
+
+        with timer('sql'), db_cursor() as cursor:
+            self._set_search_settings(cursor, [query])
+            execute_prepared(cursor, name, sql, params)
+            rows = cursor.fetchall()
+
+        with timer('score'):
+            return rerank(rows, query)
+
+    def search_batch(self, queries: List[SearchQuery]) -> List[List[dict]]:
+        """
+        :return: the results of every query, in the order of queries
+        """
+        if not queries:
+            return []
+
+        sql, params = to_pyformat(*build_batch_sql(queries))
+
+        with timer('sql'), db_cursor() as cursor:
+            self._set_search_settings(cursor, queries)
+            # The batch changes with every request, it is not worth preparing
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+
+        with timer('score'):
+            per_query = [[] for _ in queries]
+            for row in rows:
+                per_query[row[0]].append(row[1:])
+
+            return [rerank(query_rows, query) for query_rows, query in zip(per_query, queries)]
+
+    def search_page(self, query: SearchQuery, after: Optional[list], page_size: Optional[int]) -> List[dict]:
+        """
+        :param after: search_key of the last row of the previous page or None
+        :return: the page_size best results after the keyset
+        """
+        name, sql, params = build_ranked_sql(query, after, page_size)
+
+        with timer('sql'), db_cursor() as cursor:
+            self._set_search_settings(cursor, [query])
+            execute_prepared(cursor, name, sql, params)
+            rows = cursor.fetchall()
+
+        return [_ranked_result(row) for row in rows]
+
+    def search_stream(self, query: SearchQuery, after: Optional[list] = None) -> Iterator[dict]:
+        """
+        Yields the ranked results as they arrive from a server-side cursor
+        """
+        _, sql, params = build_ranked_sql(query, after)
+        sql, params = to_pyformat(sql, params)
+
+        with db_cursor(name='search_stream') as cursor:
+            with cursor.connection.cursor() as settings:
+                self._set_search_settings(settings, [query])
+
+            cursor.itersize = STREAM_ITERSIZE
+            cursor.execute(sql, params)
+            for row in cursor:
+                yield _ranked_result(row)
+
+    def explore(self, video_id: str, after: Optional[list] = None, limit: Optional[int] = None) -> List[dict]:
+        """
+        :param after: explore_key of the last row of the previous page or None
+        :param limit: number of keyframes returned or None for all
+        """
+        after_timestamp, after_frame = after or (None, None)
+
+        with timer('sql'), db_cursor() as cursor:
+            execute_prepared(cursor, 'explore_video_page', EXPLORE_SQL, (video_id, after_timestamp, after_frame, limit))
+            rows = cursor.fetchall()
+
+        return [_explore_result(row) for row in rows]
+
+    def explore_stream(self, video_id: str, after: Optional[list] = None) -> Iterator[dict]:
+        after_timestamp, after_frame = after or (None, None)
+        sql, params = to_pyformat(EXPLORE_SQL, [video_id, after_timestamp, after_frame, None])
+
+        with db_cursor(name='explore_stream') as cursor:
+            cursor.itersize = STREAM_ITERSIZE
+            cursor.execute(sql, params)
+            for row in cursor:
+                yield _explore_result(row)
+
+
+# --------------------------- Pagination
+# Cursors are opaque to the client: the keyset of the last row of a page, base64 encoded JSON
+# Types of the keyset values of search_key and explore_key
+SEARCH_KEY_TYPES = ((int, float), str, str)
+EXPLORE_KEY_TYPES = ((int, float), str)
+
+
+def encode_cursor(key: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor: Optional[str], key_types: tuple) -> Optional[list]:
+    """
+    :param key_types: SEARCH_KEY_TYPES or EXPLORE_KEY_TYPES
+    :return: the keyset of the cursor, None without a cursor
+    """
+    if not cursor:
+        return None
+
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, AttributeError):
+        raise InvalidQuery(f"Invalid cursor {cursor}")
+
+    if not isinstance(key, list) or len(key) != len(key_types) or \
+            not all([isinstance(v, t) and not isinstance(v, bool) for v, t in zip(key, key_types)]):
+        raise InvalidQuery(f"Invalid cursor {cursor}")
+
+    return key
+
+
+def search_key(result: dict) -> list:
+    return [result['score'], result['video_id'], result['frame_id']]
+
+
+def explore_key(result: dict) -> list:
+    return [result['timestamp'], result['frame_id']]
+
+
+def page_size_param(value, name: str) -> Optional[int]:
+    """
+    :param value: pageSize / limit of a request, None or '' when not given
+    :return: the positive page size or None
+    """
+    if value is None or value == '':
+        return None
+
+    try:
+        page_size = int(value)
+    except (TypeError, ValueError):
+        raise InvalidQuery(f"{name} must be a positive integer")
+
+    if isinstance(value, bool) or page_size <= 0:
+        raise InvalidQuery(f"{name} must be a positive integer")
+
+    return page_size
+
+
+def next_cursor(results: List[dict], page_size: Optional[int], key) -> Optional[str]:
+    """
+    :return: cursor of the page after results, None when results is the last page
+    """
+    if page_size is None or not results or len(results) < page_size:
+        return None
+
+    return encode_cursor(key(results[-1]))
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    Returns the search backend selected by SEARCH_BACKEND, 'postgres' or 'memory'.
+    Both answer search, search_batch, search_page, search_stream, explore and explore_stream with the same
+    response dicts
+    """
+    global _backend
+
+    with _backend_lock:
+        if _backend is None:
+            _backend = VectorIndex() if SEARCH_BACKEND == 'memory' else PostgresBackend()
+
+    return _backend
+
+
+def search(query: SearchQuery) -> List[dict]:
+    return get_backend().search(query)
+
+
+def search_batch(queries: List[SearchQuery]) -> List[List[dict]]:
+    return get_backend().search_batch(queries)
+
+
+def search_page(query: SearchQuery, after: Optional[list], page_size: Optional[int]) -> List[dict]:
+    return get_backend().search_page(query, after, page_size)
+
+
+def search_stream(query: SearchQuery, after: Optional[list] = None) -> Iterator[dict]:
+    return get_backend().search_stream(query, after)
+
+
+def explore(video_id: str, after: Optional[list] = None, limit: Optional[int] = None) -> List[dict]:
+    return get_backend().explore(video_id, after, limit)
+
+
+def explore_stream(video_id: str, after: Optional[list] = None) -> Iterator[dict]:
+    return get_backend().explore_stream(video_id, after)
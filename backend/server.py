@@ -1,24 +1,105 @@
 import os
 import json
 import base64
+import hashlib
 import re
+import time
 from io import BytesIO
 from PIL import Image
-from flask import Flask, send_from_directory, request, jsonify
+from flask import Flask, Response, g, send_from_directory, request, jsonify, stream_with_context
 from flask_cors import CORS
 
-from postgres_db import connect_to_db
-from utils import encode_image, encode_text
-from utils_server import get_neighbour_colors
-from distance import l2
+import psycopg2
+import query_cache
+from query_cache import LRUCache, encode_text_cached, encode_texts_cached, encode_image_cached
+import thumbnails
+import search_engine
+import temporal_search
+import metrics
+from metrics import timer
+from search_engine import SearchQuery, InvalidQuery, decode_cursor, next_cursor, page_size_param, search_key, \
+    explore_key, SEARCH_KEY_TYPES, EXPLORE_KEY_TYPES
 from constants import DATA_DIR
 
-conn = connect_to_db()
-cursor = conn.cursor()
+# Threaded dev server: python server.py
+# Multiple workers: gunicorn -w 4 --threads 8 -b 127.0.0.1:5000 server:app
+# Every worker process gets its own connection pool, see postgres_db.get_pool
 
 app = Flask(__name__)
 cors = CORS(app, origins='*')
 
+# Frames, thumbnails, sprites and videos change only when a video is ingested again (frame ids are reassigned).
+# URLs with ?v= the current thumbnails.video_version (the 'version' of every result) are cached for a year,
+# unversioned URLs are revalidated with their ETag after a few minutes
+STATIC_MAX_AGE = 365 * 24 * 3600
+UNVERSIONED_MAX_AGE = 300
+
+# Hot thumbnails are served from memory, (bytes, etag, mtime) per (video_id, frame_id, size)
+THUMBNAIL_CACHE_SIZE = int(os.environ.get('THUMBNAIL_CACHE_SIZE', 4096))
+thumbnail_cache = LRUCache(THUMBNAIL_CACHE_SIZE)
+
+
+# Per-request phase timings (encode, sql, score, serialize, ...) are sent in a Server-Timing header
+# when SERVER_TIMING is set or the request has an X-Server-Timing header
+SERVER_TIMING = bool(os.environ.get('SERVER_TIMING'))
+
+
+# Loads the persisted query cache, the warm-up from the query log runs in a background thread of every worker
+query_cache.init()
+
+
+@app.before_request
+def start_timing():
+    g.start_time = time.perf_counter()
+    metrics.start_collecting()
+
+
+@app.after_request
+def finish_timing(response):
+    elapsed = time.perf_counter() - g.start_time
+    phases = metrics.stop_collecting()
+
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.observe('request_seconds', elapsed, endpoint=endpoint)
+
+    if SERVER_TIMING or request.headers.get('X-Server-Timing'):
+        response.headers['Server-Timing'] = metrics.server_timing({**phases, 'total': elapsed})
+
+    return response
+
+
+@app.errorhandler(psycopg2.OperationalError)
+def database_unavailable(e):
+    return jsonify({
+        "error": "database unavailable"
+    }), 503
+
+
+@app.errorhandler(InvalidQuery)
+def bad_request(e):
+    return jsonify({
+        "error": str(e)
+    }), 400
+
+
+def versioned(results):
+    """
+    Yields the results with the 'version' of their video, to be sent as ?v= with frame, thumbnail and sprite URLs
+    """
+    versions = {}
+    for r in results:
+        if r['video_id'] not in versions:
+            versions[r['video_id']] = thumbnails.video_version(r['video_id'])
+        r['version'] = versions[r['video_id']]
+        yield r
+
+
+def ndjson(results):
+    """
+    Streams the results as newline delimited JSON, one result per line, while they are being fetched
+    """
+    return Response(stream_with_context(json.dumps(r) + '\n' for r in results), mimetype='application/x-ndjson')
+
 
 @app.route("/", methods=['GET'])
 def root():
@@ -27,6 +108,38 @@ def root():
     })
 
 
+@app.route("/metrics", methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route("/cache/stats", methods=['GET'])
+def cache_stats():
+    return jsonify({
+        **query_cache.cache.stats(),
+        'thumbnails': thumbnail_cache.stats()
+    })
+
+
+def cache_headers(response, video_id: str):
+    response.cache_control.public = True
+
+    version = request.args.get('v')
+    if version is not None and version == thumbnails.video_version(video_id):
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = UNVERSIONED_MAX_AGE
+
+    return response
+
+
+def static_file(directory: str, path: str, video_id: str):
+    # Conditional responses answer If-None-Match / If-Modified-Since with 304 and Range requests with 206
+    response = send_from_directory(directory, path, conditional=True, etag=True)
+    return cache_headers(response, video_id)
+
+
 @app.route('/video/<video_id>', methods=['GET'])
 def video(video_id: str):
     base_path = os.path.join(DATA_DIR, video_id)
@@ -35,7 +148,7 @@ def video(video_id: str):
     if not os.path.exists(os.path.join(base_path, video_path)):
         return f"<p>video does not exist {video_id}</p>"
 
-    return send_from_directory(base_path, video_path)
+    return static_file(base_path, video_path, video_id)
 
 
 @app.route('/video/<video_id>/frame/<frame_id>', methods=['GET'])
@@ -46,7 +159,73 @@ def frame(video_id: str, frame_id: str):
     if not os.path.exists(os.path.join(base_path, frame_path)):
         return f"<p>frame does not exist {frame_id}</p>"
 
-    return send_from_directory(base_path, frame_path)
+    return static_file(base_path, frame_path, video_id)
+
+
+def thumbnail_source(video_id: str, frame_id: str, size: int) -> str:
+    """
+    :return: path of the pre-generated thumbnail, of the frame when there is none
+    """
+    path = thumbnails.thumbnail_path(video_id, frame_id, size)
+    return path if os.path.exists(path) else thumbnails.frame_path(video_id, frame_id)
+
+
+def load_thumbnail(video_id: str, frame_id: str, size: int):
+    """
+    :return: (bytes, etag, mtime) of the pre-generated thumbnail, made from the frame when there is none
+    """
+    path = thumbnail_source(video_id, frame_id, size)
+
+    if path == thumbnails.thumbnail_path(video_id, frame_id, size):
+        with open(path, 'rb') as f:
+            data = f.read()
+    else:
+        data = thumbnails.thumbnail_bytes(video_id, frame_id, size)
+
+    return data, hashlib.sha1(data).hexdigest(), os.path.getmtime(path)
+
+
+@app.route('/video/<video_id>/frame/<frame_id>/thumbnail/<int:size>', methods=['GET'])
+def thumbnail(video_id: str, frame_id: str, size: int):
+    if size not in thumbnails.THUMBNAIL_SIZES or not (video_id.isdigit() and frame_id.isdigit()):
+        return f"<p>thumbnail does not exist {frame_id} {size}</p>", 404
+
+    if not os.path.exists(thumbnails.frame_path(video_id, frame_id)):
+        return f"<p>frame does not exist {frame_id}</p>", 404
+
+    key = (video_id, frame_id, size)
+    cached = thumbnail_cache.get(key)
+
+    # A video ingested again rewrites its frames and thumbnails, the cached bytes are then stale
+    if cached is None or cached[2] != os.path.getmtime(thumbnail_source(video_id, frame_id, size)):
+        cached = load_thumbnail(video_id, frame_id, size)
+        thumbnail_cache.put(key, cached)
+
+    data, etag, mtime = cached
+
+    response = Response(data, mimetype='image/jpeg')
+    response.set_etag(etag)
+    response.last_modified = mtime
+    return cache_headers(response, video_id).make_conditional(request)
+
+
+@app.route('/video/<video_id>/sprite', methods=['GET'])
+def sprite(video_id: str):
+    # Tile positions of the frames are in /video/<video_id>/sprite.json
+    return static_file(thumbnails.thumbnails_dir(video_id), f'sprite_{thumbnails.SPRITE_SIZE}.jpeg', video_id)
+
+
+@app.route('/video/<video_id>/sprite.json', methods=['GET'])
+def sprite_tiles(video_id: str):
+    return static_file(thumbnails.thumbnails_dir(video_id), f'sprite_{thumbnails.SPRITE_SIZE}.json', video_id)
+
+
+def image_query_vector(data: dict):
+    if not data['query']['imageQuery']:
+        return None
+
+    image_data = re.sub('^data:image/.+;base64,', '', data['query']['imageQuery'])
+    return encode_image_cached(base64.b64decode(image_data), lambda b: Image.open(BytesIO(b)))
 
 
 @app.route('/search', methods=['POST'])
@@ -54,106 +233,109 @@ def search():
     data = json.loads(request.data)
 
     # Generate query
-    text_vec = None
-    if data['query']['textQuery']:
-        text_vec = encode_text(data['query']['textQuery'])
-
-    image_vec = None
-    if data['query']['imageQuery']:
-        image_data = re.sub('^data:image/.+;base64,', '', data['query']['imageQuery'])
-        im = Image.open(BytesIO(base64.b64decode(image_data)))
-        image_vec = encode_image(im)
-
-    object_query_str = ''
-    if data['query']['objectQuery']:
-        if data['searchParams']['objectsContain'] == 'any':
-            object_query_str = f" AND objects && ARRAY{data['query']['objectQuery']}::text[]"
-        elif data['searchParams']['objectsContain'] == 'all':
-            object_query_str = f" AND objects @> ARRAY{data['query']['objectQuery']}::text[]"
-        elif data['searchParams']['objectsContain'] == 'only':
-            object_query_str = f" AND objects = ARRAY{sorted(data['query']['objectQuery'])}::text[]"
-
-    color_query_str = ''
-    if data['query']['colorQuery']:
-        n_colors = get_neighbour_colors(data['query']['colorQuery'], data['searchParams']['colorRadius'])
-        n_colors = [v for v in n_colors]
-        color_query_str = f' AND colors && ARRAY{n_colors}::int[]'
-
-    word_query_str = ''
-    if data['query']['wordQuery']:
-        word_query_str = f" AND text && ARRAY{data['query']['wordQuery']}::text[]"
-
-    cursor.execute(f"""
-        SELECT id, video_id, frame_id, timestamp, colors, objects, text,
-            (CASE 
-                WHEN %s IS NULL THEN 0
-                ELSE image_vector <=> %s::vector
-            END) + (CASE
-                WHEN %s IS NULL THEN 0
-                ELSE image_vector <=> %s::vector
-            END) AS distance FROM frames
-        WHERE (
-            (
-                %s IS NOT NULL AND image_vector <=> %s::vector < {data['searchParams']['maxTextSimilarity']}
-                OR
-                %s IS NOT NULL AND image_vector <=> %s::vector < {data['searchParams']['maxImageSimilarity']}
-                OR (
-                    %s IS NULL AND %s IS NULL
-                )
-            ) 
-            {object_query_str}
-            {color_query_str}
-            {word_query_str}
-        ) ORDER BY distance ASC
-    """, (text_vec, text_vec, image_vec, image_vec, text_vec, text_vec, image_vec, image_vec, text_vec, image_vec))
-
-    final_data = []
-    for doc_id, video_id, frame_id, timestamp, colors, objects, text, distance in cursor.fetchall():
-        obj = {
-            'video_id': video_id,
-            'frame_id': frame_id,
-            'timestamp': timestamp,
-            'dominant_colors': colors,
-            'objects': objects,
-            'text': text,
-            'score': distance
-        }
-
-        # Calculating color score
-        if data['query']['colorQuery']:
-            obj['score'] += min([l2(c, data['query']['colorQuery']) for c in obj['dominant_colors']]) / 255
-
-        final_data.append(obj)
+    with timer('encode'):
+        text_vec = None
+        if data['query']['textQuery']:
+            text_vec = encode_text_cached(data['query']['textQuery'])
+
+        query = SearchQuery.from_request(data, text_vec, image_query_vector(data))
+
+    # Optional keyset pagination: searchParams.pageSize and the cursor returned as 'next' by the previous page
+    page_size = page_size_param(data['searchParams'].get('pageSize'), 'pageSize')
+    after = decode_cursor(data['searchParams'].get('cursor'), SEARCH_KEY_TYPES)
+
+    if request.args.get('stream'):
+        return ndjson(versioned(search_engine.search_stream(query, after)))
+
+    if page_size is None and after is None:
+        results = list(versioned(search_engine.search(query)))
+        with timer('serialize'):
+            return jsonify({
+                'data': results
+            })
+
+    results = list(versioned(search_engine.search_page(query, after, page_size)))
+    with timer('serialize'):
+        return jsonify({
+            'data': results,
+            'next': next_cursor(results, page_size, search_key)
+        })
+
+
+def batch_queries(batch: list) -> list[SearchQuery]:
+    """
+    :param batch: bodies of /search requests
+    """
+    # All text queries of the batch in one forward pass
+    with timer('encode'):
+        texts = [data['query']['textQuery'] for data in batch if data['query']['textQuery']]
+        text_vecs = iter(encode_texts_cached(texts) if texts else [])
+
+        return [SearchQuery.from_request(data, next(text_vecs) if data['query']['textQuery'] else None,
+                                         image_query_vector(data)) for data in batch]
+
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    # Body {'queries': [body of a /search request, ...]}, the results of every query are returned in the same order
+    queries = batch_queries(json.loads(request.data)['queries'])
+    results = [list(versioned(r)) for r in search_engine.search_batch(queries)]
+
+    with timer('serialize'):
+        return jsonify({
+            'data': results
+        })
+
+
+@app.route('/search/temporal', methods=['POST'])
+def search_temporal():
+    # Body {'queries': [body of a /search request, ...], 'maxGap': seconds, 'maxResults': n}
+    # Returns sequences of frames matching the queries in order, see temporal_search.py
+    data = json.loads(request.data)
+
+    if not isinstance(data.get('queries'), list) or not data['queries']:
+        raise InvalidQuery("queries must be a non-empty list of /search request bodies")
+
+    try:
+        max_gap = float(data['maxGap'])
+    except (KeyError, TypeError, ValueError):
+        raise InvalidQuery("maxGap must be a number of seconds")
+    if not max_gap >= 0:
+        raise InvalidQuery("maxGap must be a number of seconds")
+
+    max_results = page_size_param(data.get('maxResults'), 'maxResults') or 100
+    queries = batch_queries(data['queries'])
+
+    sequences = temporal_search.search(queries, max_gap, max_results)
+    for sequence in sequences:
+        sequence['frames'] = list(versioned(sequence['frames']))
 
     return jsonify({
-        'data': sorted(final_data, key=lambda x: x['score'])[:data['searchParams']['maxResults']]
+        'data': sequences
     })
 
 
 @app.route('/explore/<video_id>', methods=['GET'])
 def explore_video(video_id: str):
-    cursor.execute(f"""
-        SELECT id, video_id, frame_id, timestamp, colors, objects, text FROM frames 
-        WHERE video_id = '{video_id}'
-        ORDER BY timestamp ASC
-    """)
-
-    final_data = []
-    for doc_id, video_id, frame_id, timestamp, colors, objects, text in cursor.fetchall():
-        final_data.append({
-            'video_id': video_id,
-            'frame_id': frame_id,
-            'timestamp': timestamp,
-            'dominant_colors': colors,
-            'objects': objects,
-            'text': text,
-            'score': 0
+    # Optional keyset pagination with ?limit= and ?cursor=, or streaming with ?stream=1
+    limit = page_size_param(request.args.get('limit'), 'limit')
+    after = decode_cursor(request.args.get('cursor'), EXPLORE_KEY_TYPES)
+
+    if request.args.get('stream'):
+        return ndjson(versioned(search_engine.explore_stream(video_id, after)))
+
+    results = list(versioned(search_engine.explore(video_id, after, limit)))
+
+    if limit is None and after is None:
+        return jsonify({
+            'data': results
         })
 
     return jsonify({
-        'data': final_data
+        'data': results,
+        'next': next_cursor(results, limit, explore_key)
     })
 
 
 if __name__ == '__main__':
-    app.run(host="127.0.0.1", port=5000, debug=False)
+    app.run(host="127.0.0.1", port=5000, debug=False, threaded=True)
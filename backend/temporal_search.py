@@ -0,0 +1,105 @@
+"""
+Temporal sequence search: "A, then B within max_gap seconds, then C ..."
+
+The sub-queries run together as one search batch. Their results are then joined per video with a merge over
+the timestamp-sorted results of consecutive sub-queries: a frame of step i extends the best sequence ending in
+a frame of step i - 1 at most max_gap seconds before it. The score of a sequence is the sum of the search
+scores of its frames, lower is better like the scores of /search.
+"""
+from collections import deque
+from typing import List
+
+import search_engine
+from search_engine import SearchQuery
+
+
+def _by_video(results: List[dict]) -> dict:
+    """
+    :return: video_id -> results of the video sorted by timestamp
+    """
+    videos = {}
+    for r in results:
+        videos.setdefault(r['video_id'], []).append(r)
+
+    for frames in videos.values():
+        frames.sort(key=lambda r: r['timestamp'])
+
+    return videos
+
+
+def _extend(previous: List[tuple], frames: List[dict], max_gap: float) -> List[tuple]:
+    """
+    One merge step over the frames of one video
+
+    :param previous: (score, frame, parent) of the best sequence ending in each frame of the previous step,
+                     sorted by timestamp
+    :param frames: results of this step, sorted by timestamp
+    :return: (score, frame, parent) of the best sequence ending in each frame that has a predecessor
+    """
+    sequences = []
+    # Sequences of the previous step within the gap, with increasing scores so the front is the best one
+    window = deque()
+    i = 0
+
+    for frame in frames:
+        t = frame['timestamp']
+
+        while i < len(previous) and previous[i][1]['timestamp'] < t:
+            while window and window[-1][0] >= previous[i][0]:
+                window.pop()
+            window.append(previous[i])
+            i += 1
+
+        while window and window[0][1]['timestamp'] < t - max_gap:
+            window.popleft()
+
+        if window:
+            sequences.append((window[0][0] + frame['score'], frame, window[0]))
+
+    return sequences
+
+
+def best_sequences(results: List[List[dict]], max_gap: float, max_results: int) -> List[dict]:
+    """
+    :param results: results of every sub-query, in the order of the sequence
+    :param max_gap: maximum seconds between consecutive frames of a sequence
+    :return: the max_results best sequences, one per frame matching the last sub-query
+    """
+    steps = [_by_video(r) for r in results]
+
+    sequences = []
+    for video_id, frames in steps[0].items():
+        current = [(frame['score'], frame, None) for frame in frames]
+
+        for step in steps[1:]:
+            if not current:
+                break
+            current = _extend(current, step.get(video_id, []), max_gap)
+
+        sequences += current
+
+    sequences.sort(key=lambda s: s[0])
+
+    response = []
+    for score, frame, parent in sequences[:max_results]:
+        frames = [frame]
+        while parent is not None:
+            _, frame, parent = parent
+            frames.append(frame)
+
+        response.append({
+            'video_id': frames[0]['video_id'],
+            'start': frames[-1]['timestamp'],
+            'end': frames[0]['timestamp'],
+            'score': score,
+            'frames': frames[::-1]
+        })
+
+    return response
+
+
+def search(queries: List[SearchQuery], max_gap: float, max_results: int) -> List[dict]:
+    """
+    :param queries: the sub-queries, in the order their frames must appear
+    """
+    return best_sequences(search_engine.search_batch(queries), max_gap, max_results)
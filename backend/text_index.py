@@ -0,0 +1,171 @@
+"""
+Normalized OCR tokens and word matching
+
+OCR output is normalized into tokens at ingest (lower case, split on anything but letters and digits).
+Word queries match tokens in one of WORD_MATCHES modes and rank frames by word_distance:
+    exact   the token equals the word
+    prefix  the token starts with the word, shorter completions rank higher
+    fuzzy   edit distance similarity (1 - edits / longer length) of at least FUZZY_MIN_SIMILARITY
+
+Fuzzy candidates are the tokens sharing a trigram with the word, verified with the edit distance. Postgres finds
+them with the pg_trgm GIN index over frames.text_doc (the tokens joined by spaces), with
+pg_trgm.word_similarity_threshold lowered to trigram_threshold so one shared trigram passes, then checks levenshtein
+and computes the same word distance in SQL. The in-process backend uses TokenIndex, an inverted index with trigram
+postings.
+"""
+import re
+import bisect
+import unicodedata
+import numpy as np
+from typing import List
+
+WORD_MATCHES = ['exact', 'prefix', 'fuzzy']
+
+# Edit distance similarity a token needs to match a word in fuzzy mode, at most 2 edits in a 5 letter word
+FUZZY_MIN_SIMILARITY = 0.6
+
+# Word lookups kept per TokenIndex
+MATCH_CACHE_SIZE = 1024
+
+
+def normalize_tokens(words: List[str]) -> List[str]:
+    """
+    :param words: raw OCR words (or already normalized tokens, normalizing is idempotent)
+    :return: distinct tokens in order of appearance
+    """
+    text = unicodedata.normalize('NFKC', ' '.join(words)).lower()
+    tokens = [t for t in re.split(r'[\W_]+', text) if t]
+
+    return list(dict.fromkeys(tokens))
+
+
+def trigrams(token: str) -> set:
+    # Padded like pg_trgm, so short words and word starts get trigrams too
+    padded = f'  {token} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def trigram_threshold(words: List[str]) -> float:
+    """
+    :return: pg_trgm.word_similarity_threshold at which a text_doc sharing one trigram with any of the words passes,
+             word_similarity is the share of the trigrams of the word found in text_doc
+    """
+    # Slightly lower, pg_trgm compares in single precision
+    return min([1 / len(trigrams(w)) for w in words]) * 0.99
+
+
+def edit_distance(a: str, b: str) -> int:
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+
+    return previous[-1]
+
+
+def token_similarity(word: str, token: str, match: str) -> float:
+    if match == 'exact':
+        return 1.0 if token == word else 0.0
+
+    if match == 'prefix':
+        return len(word) / len(token) if token.startswith(word) else 0.0
+
+    longest = max(len(word), len(token))
+    # The edit distance is at least the difference in length
+    if 1 - abs(len(word) - len(token)) / longest < FUZZY_MIN_SIMILARITY:
+        return 0.0
+
+    similarity = 1 - edit_distance(word, token) / longest
+    return similarity if similarity >= FUZZY_MIN_SIMILARITY else 0.0
+
+
+def token_similarities(words: List[str], vocabulary, match: str) -> List[dict]:
+    """
+    :param vocabulary: distinct tokens to compare the words to
+    :return: per word, token -> similarity of the tokens matching it
+    """
+    similarities = []
+    for w in words:
+        scores = {t: token_similarity(w, t, match) for t in vocabulary}
+        similarities.append({t: s for t, s in scores.items() if s > 0})
+
+    return similarities
+
+
+def word_distance(similarities: List[dict], tokens: List[str]) -> float:
+    """
+    :param similarities: token_similarities or TokenIndex.similarities of the query words
+    :param tokens: tokens of a frame
+    :return: 1 - mean over the query words of their best similarity to a token of the frame, 0 when all match exactly
+    """
+    if not similarities:
+        return 0.0
+
+    return 1 - sum([max([s.get(t, 0.0) for t in tokens], default=0.0) for s in similarities]) / len(similarities)
+
+
+class TokenIndex:
+    """
+    Token -> rows postings, with the sorted vocabulary for prefix lookups and trigram -> tokens postings
+    for fuzzy lookups
+    """
+
+    def __init__(self, texts: List[List[str]]):
+        postings = {}
+        for row, tokens in enumerate(texts):
+            for t in set(tokens):
+                postings.setdefault(t, []).append(row)
+
+        self.postings = {t: np.array(rows) for t, rows in postings.items()}
+        self.vocabulary = sorted(self.postings)
+
+        self.trigrams = {}
+        for t in self.vocabulary:
+            for g in trigrams(t):
+                self.trigrams.setdefault(g, []).append(t)
+
+        # (word, match) -> matching_tokens, the index does not change and the filter and the ranking of a query
+        # share the lookups
+        self._matches = {}
+
+    def matching_tokens(self, word: str, match: str) -> dict:
+        """
+        :return: token -> similarity of the tokens of the index matching the word
+        """
+        key = (word, match)
+        if key not in self._matches:
+            if len(self._matches) >= MATCH_CACHE_SIZE:
+                self._matches.clear()
+            self._matches[key] = self._match(word, match)
+
+        return dict(self._matches[key])
+
+    def _match(self, word: str, match: str) -> dict:
+        if match == 'exact':
+            return {word: 1.0} if word in self.postings else {}
+
+        if match == 'prefix':
+            start = bisect.bisect_left(self.vocabulary, word)
+            end = bisect.bisect_left(self.vocabulary, word + '\U0010ffff')
+            candidates = self.vocabulary[start:end]
+        else:
+            # Tokens sharing a trigram with the word, verified with the edit distance
+            candidates = set()
+            for g in trigrams(word):
+                candidates.update(self.trigrams.get(g, []))
+
+        return token_similarities([word], candidates, match)[0]
+
+    def similarities(self, words: List[str], match: str) -> List[dict]:
+        return [self.matching_tokens(w, match) for w in words]
+
+    def rows(self, similarities: List[dict]) -> np.ndarray:
+        """
+        :param similarities: of the query words, see similarities
+        :return: sorted rows with a token matching any of the words
+        """
+        postings = [self.postings[t] for s in similarities for t in s]
+
+        return np.unique(np.concatenate(postings)) if postings else np.array([], dtype=np.int64)
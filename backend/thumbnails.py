@@ -0,0 +1,141 @@
+"""
+Keyframe thumbnails and per-video sprite sheets, generated at ingest and served by server.py
+
+    {DATA_DIR}/{video_id}/thumbnails/{size}/frame_{id}.jpeg    longest side at most size pixels
+    {DATA_DIR}/{video_id}/thumbnails/sprite_{size}.jpeg        all keyframes of the video as a grid of tiles
+    {DATA_DIR}/{video_id}/thumbnails/sprite_{size}.json        tile size, columns and the tile of every frame
+
+usage (from backend/): python thumbnails.py [--videos 00001 00002]
+"""
+import os
+import re
+import json
+import argparse
+from io import BytesIO
+from PIL import Image
+
+from utils import get_video_ids
+from constants import DATA_DIR
+
+THUMBNAIL_SIZES = [160, 320]
+THUMBNAIL_QUALITY = 80
+
+# Sprite sheets of the explore view, one tile of SPRITE_SIZE per keyframe
+SPRITE_SIZE = 160
+SPRITE_COLUMNS = 10
+# JPEG images are at most 65535 pixels high
+JPEG_MAX_SIDE = 65535
+
+
+def thumbnails_dir(video_id: str) -> str:
+    return os.path.join(DATA_DIR, video_id, 'thumbnails')
+
+
+def thumbnail_path(video_id: str, frame_id: str, size: int) -> str:
+    return os.path.join(thumbnails_dir(video_id), str(size), f'frame_{frame_id}.jpeg')
+
+
+def frame_path(video_id: str, frame_id: str) -> str:
+    return os.path.join(DATA_DIR, video_id, 'frames', f'frame_{frame_id}.jpeg')
+
+
+def video_version(video_id: str):
+    """
+    Version of the keyframes of a video, for versioned URLs. generate_keyframes recreates the frames directory,
+    so it changes whenever the video is ingested again and its frame ids are reassigned
+
+    :return: hex mtime of the frames directory, None when the video has no frames
+    """
+    try:
+        return format(os.stat(os.path.join(DATA_DIR, video_id, 'frames')).st_mtime_ns, 'x')
+    except FileNotFoundError:
+        return None
+
+
+def frame_ids(video_id: str) -> list[str]:
+    """
+    :return: ids of the keyframes written by generate_keyframes, in order
+    """
+    frames_dir = os.path.join(DATA_DIR, video_id, 'frames')
+    ids = [m.group(1) for m in [re.fullmatch(r'frame_(\d+)\.jpeg', f) for f in os.listdir(frames_dir)] if m]
+
+    return sorted(ids, key=int)
+
+
+def make_thumbnail(image: Image, size: int) -> Image:
+    thumbnail = image.convert('RGB')
+    thumbnail.thumbnail((size, size), Image.LANCZOS)
+    return thumbnail
+
+
+def thumbnail_bytes(video_id: str, frame_id: str, size: int) -> bytes:
+    """
+    Thumbnail of a frame made from the full resolution frame, for sizes or frames without a pre-generated one
+    """
+    with Image.open(frame_path(video_id, frame_id)) as image:
+        out = BytesIO()
+        make_thumbnail(image, size).save(out, 'JPEG', quality=THUMBNAIL_QUALITY)
+
+    return out.getvalue()
+
+
+def generate_sprite(video_id: str, thumbnails: dict, size: int = SPRITE_SIZE, columns: int = SPRITE_COLUMNS):
+    """
+    :param thumbnails: frame_id -> thumbnail no larger than size, in keyframe order
+    :param columns: tiles per row, more for long videos so the sheet stays within the JPEG size limit
+    """
+    columns = max(columns, -(-len(thumbnails) // (JPEG_MAX_SIDE // size)))
+    rows = (len(thumbnails) + columns - 1) // columns
+    sprite = Image.new('RGB', (columns * size, max(rows, 1) * size))
+
+    tiles = {}
+    for i, (frame_id, thumbnail) in enumerate(thumbnails.items()):
+        x, y = (i % columns) * size, (i // columns) * size
+        # Thumbnails keep their aspect ratio and are centered in their tile
+        sprite.paste(thumbnail, (x + (size - thumbnail.width) // 2, y + (size - thumbnail.height) // 2))
+        tiles[frame_id] = [x, y]
+
+    base = os.path.join(thumbnails_dir(video_id), f'sprite_{size}')
+    sprite.save(base + '.jpeg', quality=THUMBNAIL_QUALITY)
+    with open(base + '.json', 'w') as f:
+        json.dump({'tile_size': size, 'columns': columns, 'tiles': tiles}, f)
+
+
+def generate_thumbnails(video_id: str, sizes: list[int] = THUMBNAIL_SIZES, sprite: bool = True) -> int:
+    """
+    Writes the thumbnails of every keyframe of a video and its sprite sheet
+
+    :return: number of keyframes
+    """
+    ids = frame_ids(video_id)
+    for size in sizes:
+        os.makedirs(os.path.join(thumbnails_dir(video_id), str(size)), exist_ok=True)
+
+    sprite_tiles = {}
+    for frame_id in ids:
+        with Image.open(frame_path(video_id, frame_id)) as image:
+            image = image.convert('RGB')
+
+        # Largest first, every smaller size is made from the previous one
+        thumbnail = image
+        for size in sorted(set(sizes) | ({SPRITE_SIZE} if sprite else set()), reverse=True):
+            thumbnail = make_thumbnail(thumbnail, size)
+            if size in sizes:
+                thumbnail.save(thumbnail_path(video_id, frame_id, size), quality=THUMBNAIL_QUALITY)
+            if sprite and size == SPRITE_SIZE:
+                sprite_tiles[frame_id] = thumbnail
+
+    if sprite:
+        generate_sprite(video_id, sprite_tiles)
+
+    return len(ids)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--videos', nargs='*', help='video ids, all videos by default')
+    parser.add_argument('--no-sprite', action='store_true')
+    args = parser.parse_args()
+
+    for video_id in args.videos or get_video_ids():
+        print(f"{video_id}: {generate_thumbnails(video_id, sprite=not args.no_sprite)} thumbnails")
@@ -1,13 +1,12 @@
 import os
 import subprocess
 
-import torch
-import clip
-import easyocr
+import cv2 as cv
 import numpy as np
 from PIL import Image
-from ultralytics import YOLO
+from models import get_clip_text, get_clip_image, get_yolo, get_ocr
 from constants import DATA_DIR
+from text_index import normalize_tokens
 from typing import Union, List, Dict, Tuple
 
 
@@ -15,68 +14,226 @@ from typing import Union, List, Dict, Tuple
 OBJECT_MIN_CONFIDENCE = 0.5
 TEXT_MIN_CONFIDENCE = 0.25
 
+# 'gated': OCR only frames that pass the text presence gate, detection on a downscaled frame and recognition
+# on the detected regions of the full frame. 'full': EasyOCR readtext on every full resolution frame.
+# 'full' stays the default until benchmarks/ocr_gate.py results back the gate: short isolated text
+# ('EXIT', a score) covers less of a 1080p frame than the threshold and is never OCRed
+OCR_MODE = os.environ.get('OCR_MODE', 'full')
+# Share of the (downscaled) frame covered by text-like edge components a frame needs to be OCRed in 'gated' mode,
+# see benchmarks/ocr_gate.py for the recall lost against the time saved per threshold
+TEXT_GATE_THRESHOLD = float(os.environ.get('TEXT_GATE_THRESHOLD', 0.002))
+TEXT_GATE_SIDE = 640
+# Longest side of the frame the text detector runs on
+OCR_DETECT_SIDE = 960
 
-model_clip, preprocess_clip = clip.load("ViT-L/14")
-model_clip.eval()
+# Increase -crf for higher compression
+COMPRESS_ARGS = ['-vcodec', 'libx264', '-acodec', 'aac', '-ac', '1', '-crf', '35']
 
 
 # FUNCTIONS
 def encode_image(image: Union[Image, os.PathLike]) -> List[float]:
-    if isinstance(image, os.PathLike):
-        image = Image.open(image)
+    return encode_images([image])[0]
+
+
+def encode_images(images: List[Union[Image, os.PathLike]]) -> List[List[float]]:
+    """
+    Encodes a batch of images with a single CLIP forward pass
+
+    :param images: list of PIL images or paths to images
+    :return: list of image vectors, in the same order as images
+    """
+    import torch
+
+    model_clip, preprocess_clip = get_clip_image()
+
+    images = [Image.open(img) if isinstance(img, os.PathLike) else img for img in images]
 
     with torch.no_grad():
-        return model_clip.encode_image(preprocess_clip(image).unsqueeze(0))[0].tolist()
+        batch = torch.stack([preprocess_clip(img) for img in images])
+        return model_clip.encode_image(batch).tolist()
 
 
 def encode_text(text: str) -> List[float]:
+    return encode_texts([text])[0]
+
+
+def encode_texts(texts: List[str]) -> List[List[float]]:
+    """
+    Encodes a batch of texts with a single CLIP forward pass
+
+    :param texts: list of texts
+    :return: list of text vectors, in the same order as texts
+    """
+    import torch
+    import clip
+
+    model_clip = get_clip_text()
+
     with torch.no_grad():
-        return model_clip.encode_text(clip.tokenize([text]))[0].tolist()
+        return model_clip.encode_text(clip.tokenize(texts)).tolist()
+
+
+def _ocr_result_to_words(res) -> List[str]:
+    # Normalized tokens, see text_index
+    return normalize_tokens([t[1] for t in res])
 
 
 def get_text_in_image(image: [Image, os.PathLike]):
-    model_ocr = easyocr.Reader(['en'], quantize=False)
+    model_ocr = get_ocr()
 
     if not isinstance(image, os.PathLike):
         image = np.array(image)
 
-    res = model_ocr.readtext(image)
+    return _ocr_result_to_words(model_ocr.readtext(image))
 
-    txt = []
-    for t in res:
-        txt += t[1].lower().split(' ')
 
-    return txt
+def _downscale(image: np.ndarray, max_side: int):
+    """
+    :return: image with its longest side at most max_side, scale factor
+    """
+    scale = min(1.0, max_side / max(image.shape[:2]))
+    if scale < 1:
+        image = cv.resize(image, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
 
+    return image, scale
 
-def get_objects_in_image(image: Image) -> Dict[str, int]:
-    model_yolo = YOLO('yolov8x.pt')
 
-    results = model_yolo(source=image, save=False, verbose=False)
+def text_presence(image: Image, max_side: int = TEXT_GATE_SIDE) -> float:
+    """
+    Cheap text presence score: strokes of characters give strong gradients that, closed horizontally,
+    merge into components wider than tall with filled bounding boxes
+
+    :param image: PIL image
+    :return: share of the downscaled frame covered by text-like components
+    """
+    gray, _ = _downscale(cv.cvtColor(np.asarray(image.convert('RGB')), cv.COLOR_RGB2GRAY), max_side)
+
+    gradient = cv.morphologyEx(gray, cv.MORPH_GRADIENT, np.ones((3, 3), np.uint8))
+    _, edges = cv.threshold(gradient, 0, 255, cv.THRESH_BINARY | cv.THRESH_OTSU)
+    lines = cv.morphologyEx(edges, cv.MORPH_CLOSE, cv.getStructuringElement(cv.MORPH_RECT, (9, 1)))
+
+    _, _, stats, _ = cv.connectedComponentsWithStats(lines, connectivity=8)
+    w, h, area = stats[1:, cv.CC_STAT_WIDTH], stats[1:, cv.CC_STAT_HEIGHT], stats[1:, cv.CC_STAT_AREA]
+    text_like = (w > 2 * h) & (h >= 6) & (h <= gray.shape[0] // 8) & (area > 0.4 * w * h)
+
+    return float(area[text_like].sum()) / gray.size
+
+
+def detect_text_regions(image: np.ndarray, max_side: int = OCR_DETECT_SIDE):
+    """
+    Runs the EasyOCR detector alone on the downscaled frame
+
+    :param image: RGB frame
+    :return: horizontal boxes [x_min, x_max, y_min, y_max] and free boxes (4 points) in frame coordinates
+    """
+    small, scale = _downscale(image, max_side)
+    horizontal, free = get_ocr().detect(small)
+
+    horizontal = [[int(round(v / scale)) for v in box] for box in horizontal[0]]
+    free = [[[int(round(x / scale)), int(round(y / scale))] for x, y in box] for box in free[0]]
+
+    return horizontal, free
+
 
-    classes = results[0].names
+def get_text_in_image_gated(image: Image, threshold: float = TEXT_GATE_THRESHOLD) -> List[str]:
+    """
+    OCR of frames with text: the gate skips frames without text-like edges, then only the regions found
+    by the detector on the downscaled frame are recognized at full resolution
+    """
+    if text_presence(image) < threshold:
+        return []
+
+    frame = np.array(image.convert('RGB'))
+    horizontal, free = detect_text_regions(frame)
+    if not horizontal and not free:
+        return []
+
+    return _ocr_result_to_words(get_ocr().recognize(frame, horizontal_list=horizontal, free_list=free))
+
+
+def get_text_in_images(images: List[Image]) -> List[List[str]]:
+    """
+    Runs OCR over a batch of images, see OCR_MODE. In 'full' mode images of the same size (keyframes of one video)
+    go through the recognizer together, mixed sizes fall back to one call per image
+
+    :param images: list of PIL images
+    :return: list of words per image
+    """
+    if OCR_MODE == 'gated':
+        return [get_text_in_image_gated(img) for img in images]
+
+    model_ocr = get_ocr()
+
+    if len({img.size for img in images}) != 1:
+        return [get_text_in_image(img) for img in images]
+
+    width, height = images[0].size
+    results = model_ocr.readtext_batched([np.array(img) for img in images], n_width=width, n_height=height)
+
+    return [_ocr_result_to_words(res) for res in results]
+
+
+def _yolo_result_to_objects(res) -> Dict[str, int]:
+    classes = res.names
+    confidence = res.boxes.conf.tolist()
 
     items = {}
-    for res in results:
-        confidence = res.boxes.conf.tolist()
-        for p in [int(c) for i, c in enumerate(res.boxes.cls.tolist()) if confidence[i] > OBJECT_MIN_CONFIDENCE]:
-            if classes[p] in items:
-                items[classes[p]] += 1
-            else:
-                items[classes[p]] = 1
+    for p in [int(c) for i, c in enumerate(res.boxes.cls.tolist()) if confidence[i] > OBJECT_MIN_CONFIDENCE]:
+        if classes[p] in items:
+            items[classes[p]] += 1
+        else:
+            items[classes[p]] = 1
 
     return items
 
 
-def get_image_colors(image: Image) -> Tuple[List[List[int]], List[int], List[int], List[int]]:
-    r, g, b = image.split()
+def get_objects_in_image(image: Image) -> Dict[str, int]:
+    return get_objects_in_images([image])[0]
 
-    pixels = image.getcolors(image.width * image.height)
+
+def get_objects_in_images(images: List[Image]) -> List[Dict[str, int]]:
+    """
+    Runs YOLO over a batch of images with a single forward pass
+
+    :param images: list of PIL images
+    :return: list of {object class: count} per image
+    """
+    model_yolo = get_yolo()
+
+    results = model_yolo(source=images, save=False, verbose=False)
+
+    return [_yolo_result_to_objects(res) for res in results]
+
+
+def get_image_colors(image: Image, max_side: int = None) -> Tuple[List[List[int]], List[int], List[int], List[int]]:
+    """
+    Dominant colors and RGB histograms of the image, computed over the packed pixel values with NumPy
+
+    :param image: PIL image
+    :param max_side: downscale (nearest neighbour, so only colors of the image are counted) until the
+                     longer side is at most max_side, the histograms are then those of the downscaled image
+    :return: 10 most dominating colors (least frequent first), red, green and blue histograms
+    """
+    image = image.convert('RGB')
+    if max_side is not None and max(image.size) > max_side:
+        scale = max_side / max(image.size)
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.NEAREST)
+
+    pixels = np.asarray(image).reshape(-1, 3)
+
+    # All three histograms with a single bincount, channel c counts values at offset c * 256
+    histograms = np.bincount((pixels + np.array([0, 256, 512], dtype=np.uint16)).ravel(), minlength=768)
+
+    packed = (pixels[:, 0].astype(np.uint32) << 16) | (pixels[:, 1].astype(np.uint32) << 8) | pixels[:, 2]
+    colors, counts = np.unique(packed, return_counts=True)
 
     # 10 most dominating colors in the image
-    dominant_colors = [list(px[1]) for px in sorted(pixels, key=lambda t: t[0])[-10:]]
+    top = np.argpartition(counts, -10)[-10:] if len(counts) > 10 else np.arange(len(counts))
+    top = top[np.argsort(counts[top], kind='stable')]
+
+    dominant_colors = [[int(c >> 16), int((c >> 8) & 255), int(c & 255)] for c in colors[top]]
 
-    return dominant_colors, r.histogram(), g.histogram(), b.histogram()
+    return dominant_colors, histograms[:256].tolist(), histograms[256:512].tolist(), histograms[512:].tolist()
 
 
 def get_video_ids():
@@ -110,11 +267,10 @@ def compress_video(video_id: str):
         src_path = os.path.join(DATA_DIR, video_id, f'{video_id}.mp4')
         target_path = os.path.join(DATA_DIR, video_id, f'{video_id}_compressed.mp4')
 
-        # Increase -crf for higher compression
-        ffmpeg = f"ffmpeg -i {src_path} -vcodec libx264 -acodec aac -ac 1 -crf 35 {target_path}"
+        ffmpeg = ['ffmpeg', '-i', src_path] + COMPRESS_ARGS + [target_path]
 
-        res = subprocess.getoutput(ffmpeg)
-        return res
+        res = subprocess.run(ffmpeg, capture_output=True, text=True)
+        return res.stderr
     except Exception as e:
         print(e)
         print(f' ======================== UNABLE TO COMPRESS {video_id} ========================')
@@ -1,5 +1,13 @@
 from typing import List
 
+import numpy as np
+
+from distance import l2_one_to_many
+
+# Dominant colors are indexed in coarse RGB bins of 2 ** COLOR_BIN_SHIFT values per channel
+COLOR_BIN_SHIFT = 5
+COLOR_BIN_LEVELS = 256 >> COLOR_BIN_SHIFT
+
 
 def get_neighbour_colors(color: List[int], n: int):
     colors = {(r, g, b) for r in range(max(0, color[0] - n), min(255, color[0] + n + 1))
@@ -9,5 +17,96 @@ def get_neighbour_colors(color: List[int], n: int):
     return list([list(c) for c in colors])
 
 
+def pack_colors(colors: List[List[int]]) -> List[int]:
+    """
+    Packs RGB triples into 24-bit ints, 0xRRGGBB
+    """
+    return [(int(r) << 16) | (int(g) << 8) | int(b) for r, g, b in colors]
+
+
+def unpack_colors(codes: List[int]) -> List[List[int]]:
+    """
+    Inverse of pack_colors
+    """
+    return [[(c >> 16) & 255, (c >> 8) & 255, c & 255] for c in codes]
+
+
+def color_bins(colors: List[List[int]]) -> List[int]:
+    """
+    Coarse bins of the colors, sorted and without duplicates
+    """
+    s = COLOR_BIN_SHIFT
+    return sorted({((int(r) >> s) * COLOR_BIN_LEVELS + (int(g) >> s)) * COLOR_BIN_LEVELS + (int(b) >> s)
+                   for r, g, b in colors})
+
+
+def get_neighbour_color_bins(color: List[int], n: int) -> List[int]:
+    """
+    Bins overlapping the cube of colors within n of color on every channel.
+    Unlike get_neighbour_colors this is bounded by the number of bins, 27 for n <= 32
+
+    :param color: RGB triple
+    :param n: radius per channel
+    :return: bins to look up
+    """
+    ranges = [range(max(0, c - n) >> COLOR_BIN_SHIFT, (min(255, c + n) >> COLOR_BIN_SHIFT) + 1) for c in color]
+
+    return [(r * COLOR_BIN_LEVELS + g) * COLOR_BIN_LEVELS + b for r in ranges[0] for g in ranges[1] for b in ranges[2]]
+
+
+def color_distances(color_codes: List[List[int]], color: List[int]) -> np.ndarray:
+    """
+    Squared L2 distance from color to the closest dominant color of every frame
+
+    :param color_codes: packed dominant colors per frame, see pack_colors
+    :param color: RGB triple
+    :return: array with one distance per frame, inf for frames without colors
+    """
+    width = max([len(codes) for codes in color_codes], default=0)
+    if width == 0:
+        return np.full(len(color_codes), np.inf)
+
+    packed = np.full((len(color_codes), width), -1, dtype=np.int64)
+    for i, codes in enumerate(color_codes):
+        packed[i, :len(codes)] = codes
+
+    return packed_color_distances(packed, color)
+
+
+def unpack_color_matrix(packed: np.ndarray) -> np.ndarray:
+    """
+    :param packed: packed colors of any shape
+    :return: array with an extra last axis of size 3 holding R, G, B
+    """
+    packed = packed.astype(np.int64)
+    return np.stack([(packed >> 16) & 255, (packed >> 8) & 255, packed & 255], axis=-1)
+
+
+def packed_color_distances(packed: np.ndarray, color: List[int]) -> np.ndarray:
+    """
+    Same as color_distances for a (frames, colors) matrix of packed colors padded with -1
+    """
+    rgb = unpack_color_matrix(packed).reshape(-1, 3).astype(np.float64)
+    distances = l2_one_to_many(np.array(color, dtype=np.float64), rgb).reshape(packed.shape)
+    distances[packed < 0] = np.inf
+
+    return distances.min(axis=1)
+
+
+def packed_colors_within(packed: np.ndarray, color: List[int], n: int) -> np.ndarray:
+    """
+    Mask of the frames with a dominant color within n of color on every channel
+
+    :param packed: (frames, colors) matrix of packed colors padded with -1
+    :param color: RGB triple
+    :param n: radius per channel
+    """
+    rgb = unpack_color_matrix(packed)
+    within = (np.abs(rgb - np.array(color, dtype=np.int64)) <= n).all(axis=-1) & (packed >= 0)
+
+    return within.any(axis=1)
+
+
 if __name__ == '__main__':
     print(get_neighbour_colors([5, 5, 5], 5))
+    print(get_neighbour_color_bins([5, 5, 5], 20))
@@ -0,0 +1,366 @@
+"""
+In-process search index over the keyframe features, used instead of Postgres with SEARCH_BACKEND=memory
+
+The index is built once from the feature store (the same frames insert_to_db loads) into INDEX_DIR:
+    vectors.npy       (frames, 768)  L2-normalized image vectors, cosine distance is 1 - dot product
+    objects.npy       (frames, 80)   bool, one column per YOLO class
+    color_codes.npy   (frames, 10)   packed dominant colors, padded with -1
+    timestamps.npy    (frames,)
+    meta.json         video_id, frame_id and text of every frame
+    ivf_*.npy         optional inverted file lists, see build_ivf
+
+and memory-mapped on load. Queries are answered with a matmul over the frames that pass the
+object / color / word filter masks, or over the nprobe closest IVF lists.
+
+usage (from backend/): python vector_index.py [--ivf 1024]
+"""
+import os
+import json
+import argparse
+import numpy as np
+from typing import Iterator, List, Optional
+
+from insert_to_db import get_data
+from distance import cosine_many_to_many
+from metrics import timer
+from text_index import TokenIndex, word_distance
+from utils_server import pack_colors, unpack_colors, packed_color_distances, packed_colors_within
+from constants import YOLO_CLASSES, DATA_DIR
+
+# Next to the dataset, not in it: every entry of DATA_DIR is taken for a video by utils.get_video_ids
+INDEX_DIR = DATA_DIR + '_index'
+
+IVF_NPROBE = int(os.environ.get('IVF_NPROBE', 16))
+KMEANS_ITERATIONS = 10
+
+# Rows per block of the assignment matmul, bounds the memory of the k-means steps
+BLOCK_SIZE = 65536
+
+
+# --------------------------- Build
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), BLOCK_SIZE):
+        assignments[start:start + BLOCK_SIZE] = np.argmax(vectors[start:start + BLOCK_SIZE] @ centroids.T, axis=1)
+
+    return assignments
+
+
+def build_ivf(vectors: np.ndarray, nlist: int, seed: int = 0):
+    """
+    Spherical k-means over the normalized vectors
+
+    :return: centroids (nlist, dim), rows sorted by list, offsets (nlist + 1) of each list in rows
+    """
+    rng = np.random.default_rng(seed)
+    nlist = min(nlist, len(vectors))
+    centroids = np.array(vectors[rng.choice(len(vectors), nlist, replace=False)], dtype=np.float32)
+
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = _assign(vectors, centroids)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        empty = np.bincount(assignments, minlength=nlist) == 0
+        # Empty lists keep their previous centroid
+        sums[empty] = centroids[empty]
+        centroids = normalize(sums).astype(np.float32)
+
+    assignments = _assign(vectors, centroids)
+    rows = np.argsort(assignments, kind='stable').astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=len(centroids)))])
+
+    return centroids, rows, offsets
+
+
+def build_index(out_dir: str = INDEX_DIR, nlist: int = 0, collapse_duplicates: bool = False):
+    """
+    Builds the index from the feature store
+
+    :param out_dir: directory the index is written to
+    :param nlist: number of IVF lists, 0 for exact search only
+    :param collapse_duplicates: skip frames that are near-duplicates of a frame of an earlier video
+    """
+    write_index(get_data(collapse_duplicates), out_dir, nlist)
+
+
+def write_index(rows, out_dir: str, nlist: int = 0):
+    """
+    :param rows: iterable of the tuples yielded by insert_to_db.get_data, frames of a video contiguous and
+                 sorted by timestamp
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    class_ids = {c: i for i, c in enumerate(YOLO_CLASSES)}
+
+    vectors = []
+    objects = []
+    color_codes = []
+    timestamps = []
+    meta = {'video_ids': [], 'frame_ids': [], 'text': []}
+
+    for video_id, frame_id, objs, image_vector, dominant_colors, timestamp, text in rows:
+        vectors.append(image_vector)
+
+        mask = np.zeros(len(YOLO_CLASSES), dtype=bool)
+        mask[[class_ids[o] for o in objs if o in class_ids]] = True
+        objects.append(mask)
+
+        codes = pack_colors(dominant_colors)
+        color_codes.append(codes + [-1] * (10 - len(codes)))
+
+        timestamps.append(timestamp)
+        meta['video_ids'].append(video_id)
+        meta['frame_ids'].append(frame_id)
+        meta['text'].append(text)
+
+    vectors = normalize(np.array(vectors, dtype=np.float32)).astype(np.float32)
+
+    np.save(os.path.join(out_dir, 'vectors.npy'), vectors)
+    np.save(os.path.join(out_dir, 'objects.npy'), np.array(objects, dtype=bool).reshape(-1, len(YOLO_CLASSES)))
+    np.save(os.path.join(out_dir, 'color_codes.npy'), np.array(color_codes, dtype=np.int32).reshape(-1, 10))
+    np.save(os.path.join(out_dir, 'timestamps.npy'), np.array(timestamps, dtype=np.float64))
+
+    if nlist > 0:
+        centroids, rows, offsets = build_ivf(vectors, nlist)
+        np.save(os.path.join(out_dir, 'ivf_centroids.npy'), centroids)
+        np.save(os.path.join(out_dir, 'ivf_rows.npy'), rows)
+        np.save(os.path.join(out_dir, 'ivf_offsets.npy'), offsets)
+
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    print(f"Indexed {len(vectors)} frames" + (f", {nlist} IVF lists" if nlist > 0 else ''))
+
+
+# --------------------------- Search
+class VectorIndex:
+
+    def __init__(self, index_dir: str = INDEX_DIR, mmap: bool = True, nprobe: int = IVF_NPROBE):
+        mmap_mode = 'r' if mmap else None
+
+        def load(name):
+            return np.load(os.path.join(index_dir, name), mmap_mode=mmap_mode)
+
+        self.vectors = load('vectors.npy')
+        self.objects = load('objects.npy')
+        self.color_codes = load('color_codes.npy')
+        self.timestamps = load('timestamps.npy')
+
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        self.video_ids = meta['video_ids']
+        self.frame_ids = meta['frame_ids']
+        self.text = meta['text']
+
+        # Inverted index of the OCR tokens, with trigram postings for the fuzzy word search
+        self.tokens = TokenIndex(self.text)
+
+        # Frames of a video are contiguous and sorted by timestamp
+        self.video_rows = {}
+        for i, video_id in enumerate(self.video_ids):
+            start, _ = self.video_rows.get(video_id, (i, i))
+            self.video_rows[video_id] = (start, i + 1)
+
+        self.nprobe = nprobe
+        self.ivf = None
+        if os.path.exists(os.path.join(index_dir, 'ivf_centroids.npy')):
+            self.ivf = load('ivf_centroids.npy'), load('ivf_rows.npy'), load('ivf_offsets.npy')
+
+    def __len__(self):
+        return len(self.video_ids)
+
+    def filter_mask(self, query) -> Optional[np.ndarray]:
+        """
+        Rows passing the object, color and word filters of a SearchQuery, None when there is no filter
+        """
+        mask = None
+
+        if query.objects:
+            columns = [YOLO_CLASSES.index(o) for o in set(query.objects) if o in YOLO_CLASSES]
+            selected = self.objects[:, columns]
+
+            if query.objects_contain == 'any':
+                mask = selected.any(axis=1)
+            elif len(columns) < len(set(query.objects)):
+                # Unknown classes are in no frame
+                mask = np.zeros(len(self), dtype=bool)
+            elif query.objects_contain == 'all':
+                mask = selected.all(axis=1)
+            elif query.objects_contain == 'only':
+                expected = np.zeros(len(YOLO_CLASSES), dtype=bool)
+                expected[columns] = True
+                mask = (self.objects == expected).all(axis=1)
+
+        if query.color:
+            color_mask = packed_colors_within(self.color_codes, query.color, query.color_radius)
+            mask = color_mask if mask is None else mask & color_mask
+
+        if query.words:
+            word_mask = np.zeros(len(self), dtype=bool)
+            word_mask[self.tokens.rows(self.tokens.similarities(query.words, query.word_match))] = True
+            mask = word_mask if mask is None else mask & word_mask
+
+        return mask
+
+    def candidate_rows(self, query) -> np.ndarray:
+        rows = None
+
+        mask = self.filter_mask(query)
+        if mask is not None:
+            rows = np.nonzero(mask)[0]
+
+        has_vector = query.text_vec is not None or query.image_vec is not None
+        if self.ivf is not None and has_vector:
+            centroids, ivf_rows, offsets = self.ivf
+            q = normalize(np.sum([v for v in [query.text_vec, query.image_vec] if v is not None], axis=0))
+            lists = np.argsort(-(centroids @ q))[:self.nprobe]
+            probed = np.concatenate([ivf_rows[offsets[i]:offsets[i + 1]] for i in lists])
+            rows = probed if rows is None else np.intersect1d(rows, probed)
+
+        return np.arange(len(self)) if rows is None else rows
+
+    def cosine_distances(self, rows: np.ndarray, vectors: List[List[float]]) -> np.ndarray:
+        """
+        :return: (len(vectors), len(rows)) cosine distances
+        """
+        q = normalize(np.array(vectors, dtype=np.float32))
+        candidates = self.vectors if len(rows) == len(self) else self.vectors[rows]
+
+        return cosine_many_to_many(q, candidates, normalized=True)
+
+    def query_vectors(self, query) -> list:
+        """
+        :return: (vector, max distance) of the text and image vectors of the query
+        """
+        return [(v, t) for v, t in [(query.text_vec, query.max_text_distance),
+                                    (query.image_vec, query.max_image_distance)] if v is not None]
+
+    def search(self, query) -> List[dict]:
+        with timer('filter'):
+            rows = self.candidate_rows(query)
+
+        with timer('distances'):
+            vectors = self.query_vectors(query)
+            distances = self.cosine_distances(rows, [v for v, _ in vectors]) if vectors else None
+
+        with timer('score'):
+            return self.rank(query, rows, distances)
+
+    def search_batch(self, queries: list) -> List[List[dict]]:
+        """
+        Distances of the vectors of all queries to all frames with one matmul, then the filters and ranking per query.
+        With IVF lists every query probes its own lists and is searched on its own
+        """
+        if self.ivf is not None:
+            return [self.search(query) for query in queries]
+
+        with timer('distances'):
+            vectors = [v for query in queries for v, _ in self.query_vectors(query)]
+            all_distances = self.cosine_distances(np.arange(len(self)), vectors) if vectors else None
+
+        results = []
+        offset = 0
+        for query in queries:
+            rows = self.candidate_rows(query)
+            n = len(self.query_vectors(query))
+            distances = all_distances[offset:offset + n][:, rows] if n else None
+            offset += n
+
+            results.append(self.rank(query, rows, distances))
+
+        return results
+
+    def rank(self, query, rows: np.ndarray, distances: Optional[np.ndarray]) -> List[dict]:
+        """
+        :param rows: candidate rows
+        :param distances: (query vectors, rows) cosine distances or None for a query without vectors
+        :return: the max_results best candidates within the thresholds, by score
+        """
+        scores = np.zeros(len(rows))
+        keep = np.ones(len(rows), dtype=bool)
+
+        vectors = self.query_vectors(query)
+        if vectors:
+            scores += distances.sum(axis=0)
+            keep = np.any([distances[i] < t for i, (_, t) in enumerate(vectors)], axis=0)
+
+        rows, scores = rows[keep], scores[keep]
+
+        if query.color:
+            scores = scores + packed_color_distances(self.color_codes[rows], query.color) / 255
+
+        if query.words:
+            similarities = self.tokens.similarities(query.words, query.word_match)
+            scores = scores + np.array([word_distance(similarities, self.text[r]) for r in rows])
+
+        if len(rows) > query.max_results:
+            top = np.argpartition(scores, query.max_results)[:query.max_results]
+            rows, scores = rows[top], scores[top]
+
+        order = np.argsort(scores, kind='stable')
+
+        return [self.result(rows[i], float(scores[i])) for i in order]
+
+    def result(self, row: int, score: float) -> dict:
+        return {
+            'video_id': self.video_ids[row],
+            'frame_id': self.frame_ids[row],
+            'timestamp': float(self.timestamps[row]),
+            'dominant_colors': unpack_colors([int(c) for c in self.color_codes[row] if c >= 0]),
+            'objects': sorted([YOLO_CLASSES[i] for i in np.nonzero(self.objects[row])[0]]),
+            'text': self.text[row],
+            'score': score
+        }
+
+    def search_page(self, query, after: Optional[list], page_size: Optional[int]) -> List[dict]:
+        """
+        :param after: (score, video_id, frame_id) of the last row of the previous page or None
+        """
+        results = sorted(self.search(query), key=lambda r: (r['score'], r['video_id'], r['frame_id']))
+        if after is not None:
+            after = tuple(after)
+            results = [r for r in results if (r['score'], r['video_id'], r['frame_id']) > after]
+
+        return results if page_size is None else results[:page_size]
+
+    def search_stream(self, query, after: Optional[list] = None) -> Iterator[dict]:
+        yield from self.search_page(query, after, None)
+
+    def explore(self, video_id: str, after: Optional[list] = None, limit: Optional[int] = None) -> List[dict]:
+        """
+        :param after: (timestamp, frame_id) of the last row of the previous page or None
+        :param limit: number of keyframes returned or None for all
+        """
+        start, end = self.video_rows.get(video_id, (0, 0))
+
+        if after is not None:
+            # Rows of a video are sorted by timestamp, skip to the first one not before the keyset
+            start += int(np.searchsorted(self.timestamps[start:end], after[0], side='left'))
+            while start < end and (float(self.timestamps[start]), self.frame_ids[start]) <= tuple(after):
+                start += 1
+
+        if limit is not None:
+            end = min(end, start + limit)
+
+        return [self.result(row, 0) for row in range(start, end)]
+
+    def explore_stream(self, video_id: str, after: Optional[list] = None) -> Iterator[dict]:
+        yield from self.explore(video_id, after)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ivf', type=int, default=0, help='number of IVF lists, 0 for exact search only')
+    parser.add_argument('--out', default=INDEX_DIR)
+    parser.add_argument('--collapse-duplicates', action='store_true',
+                        help='skip frames that are near-duplicates of frames of other videos (re-uploaded footage)')
+    args = parser.parse_args()
+
+    build_index(args.out, args.ivf, args.collapse_duplicates)
@@ -6,6 +6,7 @@ export interface IFrame {
     objects: string[]
     dominant_colors: string[][]
     text: string[]
+    version: string | null
 }
 
 export interface IVideo {
@@ -191,7 +191,7 @@ const FrameItem:FC<FrameItemProps> = ({ item }) => {
             <div className={styles.frame}>
                 <div className={styles.frameImg}>
                     <img 
-                        src={`${BASE_BACKEND_URL}/video/${item.video_id}/frame/${item.frame_id.split('_')[1]}`}
+                        src={`${BASE_BACKEND_URL}/video/${item.video_id}/frame/${item.frame_id.split('_')[1]}${item.version ? `?v=${item.version}` : ''}`}
                         alt="Frame"
                         style={{
                             width: 300,